@@ -1,117 +1,450 @@
 import sqlite3
+from collections import OrderedDict, deque, namedtuple
 from dotenv import load_dotenv
 import os
+import re
+import sys
+import threading
+import zlib
 
 # Load environment variables from .env file
 load_dotenv()
 
 # Get database URL from environment variables
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Number of database files chat history and created events are spread over, users are assigned by a hash of their ID
+DATABASE_SHARDS = max(1, int(os.getenv("DATABASE_SHARDS", "1")))
+# Row IDs of shard n start at n * SHARD_ID_SPAN, so an ID alone tells which file holds the row
+SHARD_ID_SPAN = 2 ** 48
+
+def shard_file(shard):
+    """Return the database file of a shard, shard 0 is DATABASE_URL itself and also holds the global tables"""
+    if shard == 0:
+        return DATABASE_URL
+    root, ext = os.path.splitext(DATABASE_URL)
+    return f"{root}.{shard}{ext}"
+
+def shard_files():
+    """Return the database files of all configured shards"""
+    return [shard_file(shard) for shard in range(DATABASE_SHARDS)]
+
+def user_shard_file(user_id):
+    """Return the database file holding a user's chat history and created events"""
+    # crc32 is stable across processes, unlike hash()
+    return shard_file(zlib.crc32(str(user_id).encode()) % DATABASE_SHARDS)
+
+def row_shard_file(row_id):
+    """Return the database file holding a chat_history or created_events row"""
+    return shard_file(int(row_id) // SHARD_ID_SPAN)
 
 # ---------------------------------------------------------------------------------------------------------------------------------
 """Create a table for user message history, created events history if it doesn't exist"""
+for shard, path in enumerate(shard_files()):
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    # Let the retention job hand pages freed by archived history back to the filesystem (only applies to new databases)
+    cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_history (
+            msg_id      INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id     TEXT NOT NULL,
+            role        TEXT NOT NULL,
+            message     TEXT NOT NULL,
+            timestamp   DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_history_user ON chat_history (user_id, msg_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_history_timestamp ON chat_history (timestamp)
+    ''')
+    # Messages saved before timestamps were recorded have none, they start ageing from the upgrade
+    # instead of all being archived by the first retention pass
+    cursor.execute('UPDATE chat_history SET timestamp = CURRENT_TIMESTAMP WHERE timestamp IS NULL')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS created_events (
+            event_id   INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id    TEXT NOT NULL,
+            title      TEXT NOT NULL,
+            start_time DATETIME NOT NULL,
+            end_time   DATETIME NOT NULL,
+            description TEXT,
+            location   TEXT,
+            timestamp  DATETIME DEFAULT CURRENT_TIMESTAMP,
+            google_event_id TEXT,
+            etag       TEXT
+        )
+    ''')
+    # Databases created before events kept their Google ID get the columns added
+    cursor.execute('PRAGMA table_info(created_events)')
+    columns = {row[1] for row in cursor.fetchall()}
+    for column in ('google_event_id', 'etag'):
+        if column not in columns:
+            cursor.execute(f'ALTER TABLE created_events ADD COLUMN {column} TEXT')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_created_events_user ON created_events (user_id, event_id)
+    ''')
+    # Updates and deletes coming from Google find the row by its Google ID, rows saved before it was kept have none
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_created_events_google ON created_events (user_id, google_event_id)
+    ''')
+    # Start the shard's AUTOINCREMENT counters at its own ID range, a no-op once the table has rows
+    for table in ('chat_history', 'created_events'):
+        cursor.execute('''
+            INSERT INTO sqlite_sequence (name, seq)
+            SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)
+        ''', (table, shard * SHARD_ID_SPAN, table))
+    conn.commit()
+    conn.close()
+
+# Tables that aren't per user live in the main database only
 conn = sqlite3.connect(DATABASE_URL)
 cursor = conn.cursor()
 cursor.execute('''
-    CREATE TABLE IF NOT EXISTS chat_history (
-        msg_id      INTEGER PRIMARY KEY AUTOINCREMENT,
+    CREATE TABLE IF NOT EXISTS reminders (
+        reminder_id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id     TEXT NOT NULL,
-        role        TEXT NOT NULL,
-        message     TEXT NOT NULL,
+        chat_id     TEXT NOT NULL,
+        event_id    TEXT,
+        title       TEXT NOT NULL,
+        start_time  DATETIME NOT NULL,
+        minutes     INTEGER NOT NULL,
+        remind_at   INTEGER NOT NULL,
+        status      INTEGER NOT NULL DEFAULT 0,
         timestamp   DATETIME DEFAULT CURRENT_TIMESTAMP
     )
 ''')
+# Only pending reminders are indexed, so loading the next window never touches delivered rows
+cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_reminders_pending ON reminders (remind_at, reminder_id) WHERE status = 0
+''')
+cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_reminders_event ON reminders (event_id) WHERE status = 0
+''')
 cursor.execute('''
-    CREATE TABLE IF NOT EXISTS created_events (
-        event_id   INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id    TEXT NOT NULL,
-        title      TEXT NOT NULL,
-        start_time DATETIME NOT NULL,
-        end_time   DATETIME NOT NULL,
-        description TEXT,
-        location   TEXT,
-        timestamp  DATETIME DEFAULT CURRENT_TIMESTAMP
+    CREATE TABLE IF NOT EXISTS processed_updates (
+        update_key  TEXT PRIMARY KEY,
+        created_at  INTEGER NOT NULL
     )
 ''')
+cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_processed_updates_created ON processed_updates (created_at)
+''')
 conn.commit()
 conn.close()
 
+# Upper bound of SQLite integer keys, the starting point of descending keyset pagination
+MAX_ROW_ID = 2 ** 63 - 1
+
+# Reminder status values
+REMINDER_PENDING = 0
+REMINDER_SENT = 1
+REMINDER_CANCELLED = 2
+
+# Most recent messages kept in memory per user, and returned by get_user_history
+HISTORY_CACHE_MESSAGES = int(os.getenv("HISTORY_CACHE_MESSAGES", "200"))
+# Memory all cached histories may take before the least recently active users are evicted
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# A cached message, a tuple subclass without a per-instance dict
+HistoryTurn = namedtuple('HistoryTurn', ['role', 'content'])
+
+
+class _HistoryBuffer:
+    """Ring buffer of a user's most recent messages and their estimated memory"""
+    __slots__ = ('turns', 'size')
+
+    def __init__(self, turns):
+        self.turns = deque(maxlen=HISTORY_CACHE_MESSAGES)
+        self.size = 0
+        for turn in turns:
+            self.append(turn)
+
+    def append(self, turn):
+        """Add a turn, returns the change of the buffer's size"""
+        before = self.size
+        if len(self.turns) == self.turns.maxlen:
+            self.size -= _turn_size(self.turns[0])
+        self.turns.append(turn)
+        self.size += _turn_size(turn)
+        return self.size - before
+
+
+def _turn_size(turn):
+    return sys.getsizeof(turn) + sys.getsizeof(turn.content)
+
+# User ID -> _HistoryBuffer, least recently used first
+_history_cache = OrderedDict()
+_history_cache_lock = threading.Lock()
+_history_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+# Bumped by every write the cache doesn't see, a load that raced one isn't cached
+_history_cache_version = 0
+
+
+def _evict_history():
+    """Drop the least recently used histories until the cache fits its memory cap, call with the lock held"""
+    while _history_cache_stats['bytes'] > HISTORY_CACHE_MAX_BYTES and len(_history_cache) > 1:
+        _, buffer = _history_cache.popitem(last=False)
+        _history_cache_stats['bytes'] -= buffer.size
+        _history_cache_stats['evictions'] += 1
+
+def invalidate_user_history(user_ids=None):
+    """Drop the cached history of some users, or of everyone, after their messages were deleted"""
+    global _history_cache_version
+    with _history_cache_lock:
+        _history_cache_version += 1
+        if user_ids is None:
+            _history_cache.clear()
+            _history_cache_stats['bytes'] = 0
+            return
+        for user_id in user_ids:
+            buffer = _history_cache.pop(str(user_id), None)
+            if buffer is not None:
+                _history_cache_stats['bytes'] -= buffer.size
+
+def get_history_cache_stats():
+    """Return the history cache's hit rate, evictions, users and estimated memory"""
+    with _history_cache_lock:
+        lookups = _history_cache_stats['hits'] + _history_cache_stats['misses']
+        return {
+            **_history_cache_stats,
+            'users': len(_history_cache),
+            'hit_rate': _history_cache_stats['hits'] / lookups if lookups else 0.0,
+        }
+
 # ---------------------------------------------------------------------------------------------------------------------------------
 '''AI CHAT HISTORY TABLE'''
 def save_user_message(user_id, role, message, timestamp=None):
-    """Save a user message to the database"""
-    conn = sqlite3.connect(DATABASE_URL)
+    """Save a user message to the database, and to the user's cached history if it is loaded"""
+    global _history_cache_version
+    conn = sqlite3.connect(user_shard_file(user_id))
     cursor = conn.cursor()
     cursor.execute('''
         INSERT OR REPLACE INTO chat_history (user_id, role, message, timestamp)
-        VALUES (?, ?, ?, ?)
+        VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
     ''', (user_id, role, message, timestamp))
     conn.commit()
     conn.close()
+    with _history_cache_lock:
+        # A history that isn't cached is loaded from the database on its next read, this message included
+        buffer = _history_cache.get(str(user_id))
+        if buffer is None:
+            _history_cache_version += 1
+        else:
+            _history_cache.move_to_end(str(user_id))
+            _history_cache_stats['bytes'] += buffer.append(HistoryTurn(role, message))
+            _evict_history()
 
 def get_user_history(user_id):
-    """Retrieve user message history from the database"""
-    conn = sqlite3.connect(DATABASE_URL)
+    """Retrieve the user's most recent HISTORY_CACHE_MESSAGES messages, from memory once they were loaded"""
+    key = str(user_id)
+    with _history_cache_lock:
+        buffer = _history_cache.get(key)
+        if buffer is not None:
+            _history_cache.move_to_end(key)
+            _history_cache_stats['hits'] += 1
+            return [{'role': turn.role, 'content': turn.content} for turn in buffer.turns]
+        _history_cache_stats['misses'] += 1
+        version = _history_cache_version
+    conn = sqlite3.connect(user_shard_file(user_id))
     cursor = conn.cursor()
     cursor.execute('''
-        SELECT role, message FROM chat_history
-        WHERE user_id = ?
-        ORDER BY timestamp DESC
-    ''', (user_id,))
-    history = cursor.fetchall()
-    history = [{'role': row[0], 'content': row[1]} for row in history]
+        SELECT role, message FROM (
+            SELECT msg_id, role, message FROM chat_history
+            WHERE user_id = ?
+            ORDER BY msg_id DESC
+            LIMIT ?
+        ) ORDER BY msg_id
+    ''', (user_id, HISTORY_CACHE_MESSAGES))
+    rows = cursor.fetchall()
     conn.close()
-    return history
+    buffer = _HistoryBuffer(HistoryTurn(*row) for row in rows)
+    with _history_cache_lock:
+        # Skipped if the history changed during the query or another caller loaded it meanwhile
+        if version == _history_cache_version and key not in _history_cache:
+            _history_cache[key] = buffer
+            _history_cache_stats['bytes'] += buffer.size
+            _evict_history()
+    return [{'role': turn.role, 'content': turn.content} for turn in buffer.turns]
+
+def _iter_shard_history(path, user_id, batch_size):
+    """Yield the message history of one shard newest first, one page at a time"""
+    last_msg_id = MAX_ROW_ID
+    while True:
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        if user_id is None:
+            cursor.execute('''
+                SELECT msg_id, user_id, role, message, timestamp FROM chat_history
+                WHERE msg_id < ?
+                ORDER BY msg_id DESC
+                LIMIT ?
+            ''', (last_msg_id, batch_size))
+        else:
+            cursor.execute('''
+                SELECT msg_id, user_id, role, message, timestamp FROM chat_history
+                WHERE user_id = ? AND msg_id < ?
+                ORDER BY msg_id DESC
+                LIMIT ?
+            ''', (user_id, last_msg_id, batch_size))
+        rows = cursor.fetchall()
+        conn.close()
+        for row in rows:
+            yield {'msg_id': row[0], 'user_id': row[1], 'role': row[2], 'message': row[3], 'timestamp': row[4]}
+        if len(rows) < batch_size:
+            return
+        last_msg_id = rows[-1][0]
+
+def iter_user_history(user_id=None, batch_size=1000):
+    """Yield message history newest first, for one user or everyone (shard by shard), one page at a time.
+    Pages are fetched by msg_id (keyset pagination), so memory stays constant however large the table is"""
+    paths = shard_files() if user_id is None else [user_shard_file(user_id)]
+    for path in paths:
+        yield from _iter_shard_history(path, user_id, batch_size)
 
 def get_all_user_history():
-    """Retrieve all user message history from the database"""
-    conn = sqlite3.connect(DATABASE_URL)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT user_id, role, message, timestamp FROM chat_history
-        ORDER BY timestamp DESC
-    ''')
-    all_history = cursor.fetchall()
-    all_history = [{'user_id': row[0], 'role': row[1], 'message': row[2], 'timestamp': row[3]} for row in all_history]
-    conn.close()
-    return all_history
+    """Retrieve all user message history from the database, prefer iter_user_history for large tables"""
+    return list(iter_user_history())
 
 def clear_user_history(user_id):
     """Clear user message history from the database"""
-    conn = sqlite3.connect(DATABASE_URL)
+    conn = sqlite3.connect(user_shard_file(user_id))
     cursor = conn.cursor()
     cursor.execute('''
         DELETE FROM chat_history WHERE user_id = ?
     ''', (user_id,))
     conn.commit()
     conn.close()
+    invalidate_user_history([user_id])
     
 def clear_all_user_history():
-    """Clear all user message history from the database"""
-    conn = sqlite3.connect(DATABASE_URL)
+    """Clear all user message history from every shard"""
+    for path in shard_files():
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            DELETE FROM chat_history
+        ''')
+        conn.commit()
+        conn.close()
+    invalidate_user_history()
+
+def get_history_user_counts(min_count):
+    """Retrieve the users with more than `min_count` messages and their message counts"""
+    counts = {}
+    for path in shard_files():
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT user_id, COUNT(*) FROM chat_history
+            GROUP BY user_id
+            HAVING COUNT(*) > ?
+        ''', (min_count,))
+        counts.update(cursor.fetchall())
+        conn.close()
+    return counts
+
+def get_history_over_limit(user_id, keep, limit):
+    """Retrieve up to `limit` of the user's oldest messages beyond their newest `keep` messages"""
+    conn = sqlite3.connect(user_shard_file(user_id))
     cursor = conn.cursor()
     cursor.execute('''
-        DELETE FROM chat_history
-    ''')
-    conn.commit()
+        SELECT msg_id, user_id, role, message, timestamp FROM chat_history
+        WHERE user_id = ? AND msg_id < (
+            SELECT msg_id FROM chat_history WHERE user_id = ? ORDER BY msg_id DESC LIMIT 1 OFFSET ?
+        )
+        ORDER BY msg_id
+        LIMIT ?
+    ''', (user_id, user_id, keep - 1, limit))
+    rows = cursor.fetchall()
+    rows = [{'msg_id': row[0], 'user_id': row[1], 'role': row[2], 'message': row[3], 'timestamp': row[4]} for row in rows]
     conn.close()
+    return rows
+
+def get_history_older_than(cutoff, limit):
+    """Retrieve up to `limit` messages saved before the `cutoff` timestamp, oldest first within each shard"""
+    rows = []
+    for path in shard_files():
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT msg_id, user_id, role, message, timestamp FROM chat_history
+            WHERE timestamp < ?
+            ORDER BY timestamp
+            LIMIT ?
+        ''', (cutoff, limit - len(rows)))
+        rows += [{'msg_id': row[0], 'user_id': row[1], 'role': row[2], 'message': row[3], 'timestamp': row[4]} for row in cursor.fetchall()]
+        conn.close()
+        if len(rows) >= limit:
+            break
+    return rows
+
+def delete_history_messages(msg_ids):
+    """Delete messages by their IDs"""
+    by_path = {}
+    for msg_id in msg_ids:
+        by_path.setdefault(row_shard_file(msg_id), []).append(msg_id)
+    for path, shard_msg_ids in by_path.items():
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            DELETE FROM chat_history WHERE msg_id IN ({', '.join('?' * len(shard_msg_ids))})
+        ''', tuple(shard_msg_ids))
+        conn.commit()
+        conn.close()
+
+def incremental_vacuum(max_pages):
+    """Return up to `max_pages` free pages of each shard to the filesystem, returns False if a shard doesn't use incremental vacuum"""
+    vacuumed = True
+    for path in shard_files():
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute('PRAGMA auto_vacuum')
+        # 2 means INCREMENTAL, older databases need a one-off VACUUM after setting it
+        if cursor.fetchone()[0] != 2:
+            vacuumed = False
+        else:
+            cursor.execute(f'PRAGMA incremental_vacuum({int(max_pages)})')
+            cursor.fetchall()
+            conn.commit()
+        conn.close()
+    return vacuumed
 
 # ---------------------------------------------------------------------------------------------------------------------------------
 '''CREATED EVENTS TABLE'''
-def save_created_event(user_id, title, start_time, end_time, description=None, location=None):
+def save_created_event(user_id, title, start_time, end_time, description=None, location=None, google_event_id=None, etag=None):
     """Save a created event to the database"""
-    conn = sqlite3.connect(DATABASE_URL)
+    conn = sqlite3.connect(user_shard_file(user_id))
     cursor = conn.cursor()
     cursor.execute('''
-        INSERT INTO created_events (user_id, title, start_time, end_time, description, location)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (user_id, title, start_time, end_time, description, location))
+        INSERT INTO created_events (user_id, title, start_time, end_time, description, location, google_event_id, etag)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (user_id, title, start_time, end_time, description, location, google_event_id, etag))
     conn.commit()
     conn.close()    
     
+def save_created_events(events):
+    """Save many created events to the database in a single transaction per shard.
+    Each event is a dict with user_id, title, start_time, end_time, and optionally description, location, google_event_id and etag"""
+    by_path = {}
+    for event in events:
+        by_path.setdefault(user_shard_file(event['user_id']), []).append(event)
+    for path, shard_events in by_path.items():
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO created_events (user_id, title, start_time, end_time, description, location, google_event_id, etag)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(event['user_id'], event['title'], event['start_time'], event['end_time'], event.get('description'), event.get('location'),
+               event.get('google_event_id'), event.get('etag'))
+              for event in shard_events])
+        conn.commit()
+        conn.close()
+
 def get_created_events(user_id):
     """Retrieve created events for a user from the database"""
-    conn = sqlite3.connect(DATABASE_URL)
+    conn = sqlite3.connect(user_shard_file(user_id))
     cursor = conn.cursor()
     cursor.execute('''
         SELECT title, start_time, end_time, description, location FROM created_events
@@ -125,7 +458,7 @@ def get_created_events(user_id):
 
 def get_event_by_id(event_id):
     """Retrieve a specific event by its ID"""
-    conn = sqlite3.connect(DATABASE_URL)
+    conn = sqlite3.connect(row_shard_file(event_id))
     cursor = conn.cursor()
     cursor.execute('''
         SELECT user_id, title, start_time, end_time, description, location FROM created_events
@@ -147,7 +480,7 @@ def get_event_by_id(event_id):
 
 def delete_event(event_id):
     """Delete an event by its ID"""
-    conn = sqlite3.connect(DATABASE_URL)
+    conn = sqlite3.connect(row_shard_file(event_id))
     cursor = conn.cursor()
     cursor.execute('''
         DELETE FROM created_events WHERE event_id = ?
@@ -157,7 +490,7 @@ def delete_event(event_id):
     
 def update_event_in_db(event_id, title=None, start_time=None, end_time=None, description=None, location=None):
     """Update an existing event by its ID"""
-    conn = sqlite3.connect(DATABASE_URL)
+    conn = sqlite3.connect(row_shard_file(event_id))
     cursor = conn.cursor()
     updates = []
     params = []
@@ -187,23 +520,325 @@ def update_event_in_db(event_id, title=None, start_time=None, end_time=None, des
     conn.commit()
     conn.close()    
         
+def update_event_by_google_id(user_id, google_event_id, etag=None, title=None, start_time=None, end_time=None, description=None, location=None):
+    """Update a user's event by its Google event ID, returns False if the event isn't in the database"""
+    conn = sqlite3.connect(user_shard_file(user_id))
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE created_events SET
+            etag = COALESCE(?, etag),
+            title = COALESCE(?, title),
+            start_time = COALESCE(?, start_time),
+            end_time = COALESCE(?, end_time),
+            description = COALESCE(?, description),
+            location = COALESCE(?, location)
+        WHERE user_id = ? AND google_event_id = ?
+    ''', (etag, title or None, start_time or None, end_time or None, description or None, location or None, str(user_id), google_event_id))
+    updated = cursor.rowcount > 0
+    conn.commit()
+    conn.close()
+    return updated
+
+def delete_event_by_google_id(user_id, google_event_id):
+    """Delete a user's event by its Google event ID"""
+    conn = sqlite3.connect(user_shard_file(user_id))
+    cursor = conn.cursor()
+    cursor.execute('''
+        DELETE FROM created_events WHERE user_id = ? AND google_event_id = ?
+    ''', (str(user_id), google_event_id))
+    conn.commit()
+    conn.close()
+
+def get_synced_events(user_id):
+    """Retrieve the user's events that have a Google event ID, by that ID"""
+    conn = sqlite3.connect(user_shard_file(user_id))
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT google_event_id, etag, title, start_time, end_time FROM created_events
+        WHERE user_id = ? AND google_event_id IS NOT NULL
+    ''', (str(user_id),))
+    events = {row[0]: {'etag': row[1], 'title': row[2], 'start_time': row[3], 'end_time': row[4]} for row in cursor.fetchall()}
+    conn.close()
+    return events
+
+def get_synced_users():
+    """Retrieve the users with at least one event that has a Google event ID, across all shards"""
+    user_ids = set()
+    for path in shard_files():
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT DISTINCT user_id FROM created_events WHERE google_event_id IS NOT NULL
+        ''')
+        user_ids.update(row[0] for row in cursor.fetchall())
+        conn.close()
+    return user_ids
+
+def apply_event_sync(user_id, updated, deleted_ids):
+    """Apply a reconciliation in one transaction: `updated` are dicts with google_event_id, etag, title, start_time,
+    end_time, description and location, `deleted_ids` are Google event IDs"""
+    if not updated and not deleted_ids:
+        return
+    conn = sqlite3.connect(user_shard_file(user_id))
+    cursor = conn.cursor()
+    cursor.executemany('''
+        UPDATE created_events SET etag = ?, title = ?, start_time = ?, end_time = ?, description = ?, location = ?
+        WHERE user_id = ? AND google_event_id = ?
+    ''', [(event['etag'], event['title'], event['start_time'], event['end_time'], event.get('description'), event.get('location'),
+           str(user_id), event['google_event_id']) for event in updated])
+    cursor.executemany('''
+        DELETE FROM created_events WHERE user_id = ? AND google_event_id = ?
+    ''', [(str(user_id), google_event_id) for google_event_id in deleted_ids])
+    conn.commit()
+    conn.close()
+
+def _iter_shard_created_events(path, user_id, batch_size):
+    """Yield the created events of one shard newest first, one page at a time"""
+    last_event_id = MAX_ROW_ID
+    while True:
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        if user_id is None:
+            cursor.execute('''
+                SELECT event_id, user_id, title, start_time, end_time, description, location FROM created_events
+                WHERE event_id < ?
+                ORDER BY event_id DESC
+                LIMIT ?
+            ''', (last_event_id, batch_size))
+        else:
+            cursor.execute('''
+                SELECT event_id, user_id, title, start_time, end_time, description, location FROM created_events
+                WHERE user_id = ? AND event_id < ?
+                ORDER BY event_id DESC
+                LIMIT ?
+            ''', (user_id, last_event_id, batch_size))
+        rows = cursor.fetchall()
+        conn.close()
+        for row in rows:
+            yield {
+                'event_id': row[0],
+                'user_id': row[1],
+                'title': row[2],
+                'start_time': row[3],
+                'end_time': row[4],
+                'description': row[5],
+                'location': row[6]
+            }
+        if len(rows) < batch_size:
+            return
+        last_event_id = rows[-1][0]
+
+def iter_created_events(user_id=None, batch_size=1000):
+    """Yield created events newest first, for one user or everyone (shard by shard), one page at a time.
+    Pages are fetched by event_id (keyset pagination), so memory stays constant however large the table is"""
+    paths = shard_files() if user_id is None else [user_shard_file(user_id)]
+    for path in paths:
+        yield from _iter_shard_created_events(path, user_id, batch_size)
+
 def get_all_created_events():
-    """Retrieve all created events from the database"""
+    """Retrieve all created events from the database, prefer iter_created_events for large tables"""
+    return list(iter_created_events())
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+'''REMINDERS TABLE'''
+def save_reminders(reminders):
+    """Save reminders to the database and return their IDs.
+    Each reminder is a dict with user_id, chat_id, event_id, title, start_time, minutes and remind_at."""
+    conn = sqlite3.connect(DATABASE_URL)
+    cursor = conn.cursor()
+    reminder_ids = []
+    for reminder in reminders:
+        cursor.execute('''
+            INSERT INTO reminders (user_id, chat_id, event_id, title, start_time, minutes, remind_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (reminder['user_id'], reminder['chat_id'], reminder.get('event_id'), reminder['title'],
+              reminder['start_time'], reminder['minutes'], reminder['remind_at']))
+        reminder_ids.append(cursor.lastrowid)
+    conn.commit()
+    conn.close()
+    return reminder_ids
+
+def get_pending_reminders(after_remind_at, after_reminder_id, until, limit=5000):
+    """Retrieve pending reminders due before `until`, ordered by (remind_at, reminder_id) and
+    starting after the given key, so callers can page through them without rescanning"""
     conn = sqlite3.connect(DATABASE_URL)
     cursor = conn.cursor()
     cursor.execute('''
-        SELECT event_id, user_id, title, start_time, end_time, description, location FROM created_events
-        ORDER BY timestamp DESC
-    ''')
-    all_events = cursor.fetchall()
-    all_events = [{
-        'event_id': row[0],
+        SELECT reminder_id, user_id, chat_id, event_id, title, start_time, minutes, remind_at FROM reminders
+        WHERE status = 0 AND (remind_at, reminder_id) > (?, ?) AND remind_at < ?
+        ORDER BY remind_at, reminder_id
+        LIMIT ?
+    ''', (after_remind_at, after_reminder_id, until, limit))
+    reminders = cursor.fetchall()
+    reminders = [{
+        'reminder_id': row[0],
         'user_id': row[1],
-        'title': row[2],
-        'start_time': row[3],
-        'end_time': row[4],
-        'description': row[5],
-        'location': row[6]
-    } for row in all_events]
-    conn.close()
-    return all_events        
\ No newline at end of file
+        'chat_id': row[2],
+        'event_id': row[3],
+        'title': row[4],
+        'start_time': row[5],
+        'minutes': row[6],
+        'remind_at': row[7]
+    } for row in reminders]
+    conn.close()
+    return reminders
+
+def get_reminders_by_ids(reminder_ids):
+    """Retrieve the pending reminders among the given IDs"""
+    if not reminder_ids:
+        return []
+    conn = sqlite3.connect(DATABASE_URL)
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT reminder_id, chat_id, title, start_time, minutes FROM reminders
+        WHERE status = 0 AND reminder_id IN ({', '.join('?' * len(reminder_ids))})
+    ''', tuple(reminder_ids))
+    reminders = cursor.fetchall()
+    reminders = [{'reminder_id': row[0], 'chat_id': row[1], 'title': row[2], 'start_time': row[3], 'minutes': row[4]} for row in reminders]
+    conn.close()
+    return reminders
+
+def get_event_reminder_minutes(event_id):
+    """Retrieve the minutes of the pending reminders of an event"""
+    conn = sqlite3.connect(DATABASE_URL)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT minutes FROM reminders
+        WHERE status = 0 AND event_id = ?
+    ''', (event_id,))
+    minutes = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    return minutes
+
+def set_reminders_status(reminder_ids, status):
+    """Mark pending reminders as sent or cancelled"""
+    if not reminder_ids:
+        return
+    conn = sqlite3.connect(DATABASE_URL)
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        UPDATE reminders SET status = ? WHERE status = 0 AND reminder_id IN ({', '.join('?' * len(reminder_ids))})
+    ''', (status, *reminder_ids))
+    conn.commit()
+    conn.close()
+
+def cancel_event_reminders(event_id):
+    """Cancel all pending reminders of an event"""
+    conn = sqlite3.connect(DATABASE_URL)
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE reminders SET status = ? WHERE status = 0 AND event_id = ?
+    ''', (REMINDER_CANCELLED, event_id))
+    conn.commit()
+    conn.close()
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+'''SHARD REBALANCING'''
+# Held shared by every running bot and exclusively while rows move between shard files, so the two never overlap
+DATABASE_LOCK_FILE = f"{os.path.splitext(DATABASE_URL)[0]}.lock"
+
+def acquire_database_lock(exclusive=False):
+    """Take the lock of the database files and return the connection holding it, closing the connection releases it.
+    Raises RuntimeError right away if a bot holds it and an exclusive lock was asked for, or the other way round"""
+    conn = sqlite3.connect(DATABASE_LOCK_FILE, timeout=0, isolation_level=None)
+    try:
+        if exclusive:
+            conn.execute('BEGIN EXCLUSIVE')
+        else:
+            # A read transaction keeps a shared lock on the file until it ends, which is when the connection closes
+            conn.execute('BEGIN')
+            conn.execute('SELECT count(*) FROM sqlite_master').fetchall()
+    except sqlite3.OperationalError:
+        conn.close()
+        raise RuntimeError(f"{DATABASE_LOCK_FILE} is locked, a bot is running or the shards are being rebalanced")
+    return conn
+
+def existing_shard_files():
+    """Return every shard file on disk, including shards left over from a larger DATABASE_SHARDS"""
+    root, ext = os.path.splitext(DATABASE_URL)
+    directory = os.path.dirname(root) or '.'
+    pattern = re.compile(re.escape(os.path.basename(root)) + r'\.(\d+)' + re.escape(ext) + '$')
+    shards = sorted(int(match.group(1)) for match in map(pattern.match, os.listdir(directory)) if match)
+    return [DATABASE_URL] + [shard_file(shard) for shard in shards if shard > 0]
+
+def get_misplaced_users(path):
+    """Retrieve the users with rows in a shard file that now belong to another shard, and their target files"""
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT user_id FROM chat_history
+        UNION
+        SELECT user_id FROM created_events
+    ''')
+    user_ids = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    return {user_id: user_shard_file(user_id) for user_id in user_ids if user_shard_file(user_id) != path}
+
+def move_user_rows(user_id, source, target):
+    """Move a user's chat history and created events from one shard file to another in a single transaction.
+    Rows get new IDs in the target's range, message order is kept. Returns the number of moved rows"""
+    conn = sqlite3.connect(source)
+    cursor = conn.cursor()
+    cursor.execute('ATTACH DATABASE ? AS target', (target,))
+    # Both files are written in one transaction, a crash leaves the rows in exactly one of them
+    cursor.execute('''
+        INSERT INTO target.chat_history (user_id, role, message, timestamp)
+        SELECT user_id, role, message, timestamp FROM main.chat_history
+        WHERE user_id = ?
+        ORDER BY msg_id
+    ''', (user_id,))
+    moved = cursor.rowcount
+    cursor.execute('''
+        INSERT INTO target.created_events (user_id, title, start_time, end_time, description, location, timestamp, google_event_id, etag)
+        SELECT user_id, title, start_time, end_time, description, location, timestamp, google_event_id, etag FROM main.created_events
+        WHERE user_id = ?
+        ORDER BY event_id
+    ''', (user_id,))
+    moved += cursor.rowcount
+    cursor.execute('''
+        DELETE FROM main.chat_history WHERE user_id = ?
+    ''', (user_id,))
+    cursor.execute('''
+        DELETE FROM main.created_events WHERE user_id = ?
+    ''', (user_id,))
+    conn.commit()
+    cursor.execute('DETACH DATABASE target')
+    conn.close()
+    return moved
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+'''PROCESSED UPDATES TABLE'''
+def claim_processed_update(update_key, now, cutoff):
+    """Record that an update is being processed, returns False if the key was already recorded at or after `cutoff`.
+    Older records of the key are taken over, so content keys only suppress duplicates within their window"""
+    conn = sqlite3.connect(DATABASE_URL)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO processed_updates (update_key, created_at) VALUES (?, ?)
+        ON CONFLICT (update_key) DO UPDATE SET created_at = excluded.created_at
+        WHERE processed_updates.created_at < ?
+    ''', (update_key, now, cutoff))
+    claimed = cursor.rowcount > 0
+    conn.commit()
+    conn.close()
+    return claimed
+
+def release_processed_update(update_key):
+    """Forget a processed update key so the same content can be processed again"""
+    conn = sqlite3.connect(DATABASE_URL)
+    cursor = conn.cursor()
+    cursor.execute('''
+        DELETE FROM processed_updates WHERE update_key = ?
+    ''', (update_key,))
+    conn.commit()
+    conn.close()
+
+def prune_processed_updates(before):
+    """Delete processed update keys recorded before the `before` timestamp"""
+    conn = sqlite3.connect(DATABASE_URL)
+    cursor = conn.cursor()
+    cursor.execute('''
+        DELETE FROM processed_updates WHERE created_at < ?
+    ''', (before,))
+    conn.commit()
+    conn.close()
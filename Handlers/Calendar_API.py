@@ -2,40 +2,82 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
+from datetime import datetime, timezone
+import logging
 import os
-from DB import save_created_event, get_created_events, delete_event, update_event_in_db, delete_event
+import re
+import uuid
+from DB import save_created_event, get_created_events, delete_event_by_google_id, update_event_by_google_id
+from Handlers.recurrence import expand_events
+from Handlers.resilience import call, _error_status
+from Handlers.token_refresher import token_path as get_token_path, save_credentials, track_credentials, get_tracked_credentials
 import googleapiclient.discovery_cache
 googleapiclient.discovery_cache.DISABLE_FILE_CACHE = True
 
+logger = logging.getLogger(__name__)
+
 
 # Function to authenticate user with Google Calendar API
 # This function will create a token into a JSON file for the user if it doesn't exist
 # This function returns the service object to interact with Google Calendar API
 def authenticate_user(user_id: int):
     SCOPES = ['https://www.googleapis.com/auth/calendar']
-    token_path = f'tokens/{user_id}.json'
+    token_path = get_token_path(user_id)
     credentials_path = 'credentials.json'
     # Create tokens directory if it doesn't exist
     os.makedirs('tokens', exist_ok=True)
-    creds = None
+    # Credentials kept fresh by the background refresher skip the file read and the refresh
+    creds = get_tracked_credentials(user_id)
     # Check if the token file exists
-    if os.path.exists(token_path):
+    if creds is None and os.path.exists(token_path):
         creds = Credentials.from_authorized_user_file(token_path, SCOPES)
     # If there are no valid credentials available, let the user log in
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())   
+            creds.refresh(Request())
+            save_credentials(user_id, creds)
         else:
             flow = InstalledAppFlow.from_client_secrets_file(
                 credentials_path, SCOPES)
             flow.redirect_uri = 'http://localhost:8080/'
             creds = flow.run_local_server(port=8080, access_type='offline', prompt='consent')
-            with open(token_path, 'w') as token_file:
-                token_file.write(creds.to_json())
+            save_credentials(user_id, creds)
+    # Let the background refresher renew the token before it expires next time
+    track_credentials(user_id, creds)
     service = build('calendar', 'v3', credentials=creds)
     return service
 
-def create_event_dict(title, start_time, end_time, description=None, location=None):
+def to_timestamp(value):
+    """Convert an ISO 8601 date or datetime string to a unix timestamp, naive times are treated as UTC."""
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+def parse_reminder_minutes(value):
+    """Parse the Reminders field returned by the model into a list of minutes, e.g. "15, 60" -> [15, 60]."""
+    if not value or value.strip().upper() == 'N/A':
+        return []
+    return sorted({int(minutes) for minutes in re.findall(r'\d+', value)})
+
+def create_reminders_dict(minutes=None):
+    """Create the reminders section of a calendar event, using popups at the given minutes if any."""
+    if minutes:
+        return {
+            'useDefault': False,
+            'overrides': [{'method': 'popup', 'minutes': m} for m in minutes],
+        }
+    return {
+        'useDefault': False,
+        'overrides': [
+            {'method': 'email', 'minutes': 24 * 60},  # 1 day before
+            {'method': 'popup', 'minutes': 10},       # 10 minutes before
+        ],
+    }
+
+def create_event_dict(title, start_time, end_time, description=None, location=None, reminders=None):
     """Create a dictionary for a calendar event."""
     event = {
         'summary': title,
@@ -49,20 +91,30 @@ def create_event_dict(title, start_time, end_time, description=None, location=No
             'dateTime': end_time,
             'timeZone': 'UTC',
         },
-        'reminders': {
-            'useDefault': False,
-            'overrides': [
-                {'method': 'email', 'minutes': 24 * 60},  # 1 day before
-                {'method': 'popup', 'minutes': 10},       # 10 minutes before
-            ],
-        },
+        'reminders': create_reminders_dict(reminders),
     }
     return event
 
+def new_event_id():
+    """Return an event ID chosen by the bot, so a retried insert can't create the event twice.
+    Google accepts lowercase base32hex IDs of 5 to 1024 characters, which hex digits are a subset of"""
+    return uuid.uuid4().hex
+
+def insert_event(service, event, user_id=None):
+    """Insert an event that has a bot-chosen ID, returning the created event.
+    An insert retried after it already reached Google finds its ID taken, the event is then read back"""
+    try:
+        return call('calendar', service.events().insert(calendarId='primary', body=event).execute, key=user_id)
+    except Exception as e:
+        if _error_status(e) != 409:
+            raise
+        return call('calendar', service.events().get(calendarId='primary', eventId=event['id']).execute, key=user_id)
+
 def create_event(service, event, user_id):
     """Create a new event in the user's primary calendar."""
     try:
-        created_event = service.events().insert(calendarId='primary', body=event).execute()
+        event = {**event, 'id': event.get('id') or new_event_id()}
+        created_event = insert_event(service, event, user_id)
         # Save the created event to the database
         save_created_event(
             user_id=user_id,
@@ -70,57 +122,80 @@ def create_event(service, event, user_id):
             start_time=event['start']['dateTime'],
             end_time=event['end']['dateTime'],
             description=event.get('description'),
-            location=event.get('location')
+            location=event.get('location'),
+            google_event_id=created_event.get('id'),
+            etag=created_event.get('etag')
         )
-        print(f"Event created: {created_event.get('htmlLink')}")
+        logger.info(f"Event created: {created_event.get('id')}")
         return created_event
     except Exception as e:
-        print(f"An error occurred: {e}")
+        logger.error(f"Could not create event: {e}")
         return None
     
-def list_events(service, max_results=10, time_min=None, time_max=None):
-    """List the next n events from the user's primary calendar."""
+def list_events(service, max_results=10, time_min=None, time_max=None, raise_errors=False, expand_recurring=True, user_id=None):
+    """List the next n events from the user's primary calendar.
+    Recurring events are expanded locally into their instances between time_min and time_max.
+    Errors are printed and an empty list returned unless raise_errors is set.
+    `user_id` applies the user's own Calendar rate limit."""
     try:
-        events_result = service.events().list(calendarId='primary', maxResults=max_results, singleEvents=False, timeMin=time_min, timeMax=time_max).execute()
+        events_result = call('calendar', service.events().list(calendarId='primary', maxResults=max_results, singleEvents=False, timeMin=time_min, timeMax=time_max).execute, key=user_id)
         events = events_result.get('items', [])
         if not events:
-            print('No upcoming events found.')
+            logger.debug('No upcoming events found.')
+        # Cancelled instances of recurring events come back without start and end
         events = [{'id': event['id'],
                    'summary': event.get('summary', 'No Title'),
                    'description': event.get('description', ''),
                    'location': event.get('location', ''),
-                   'start': event['start'].get('dateTime', event['start'].get('date')),
-                   'end': event['end'].get('dateTime', event['end'].get('date'))} for event in events]    
+                   'start': event.get('start', {}).get('dateTime', event.get('start', {}).get('date')),
+                   'end': event.get('end', {}).get('dateTime', event.get('end', {}).get('date')),
+                   'time_zone': event.get('start', {}).get('timeZone'),
+                   'recurrence': event.get('recurrence'),
+                   'recurring_event_id': event.get('recurringEventId'),
+                   'original_start': event.get('originalStartTime', {}).get('dateTime', event.get('originalStartTime', {}).get('date')),
+                   'status': event.get('status'),
+                   'updated': event.get('updated')} for event in events]    
+        if expand_recurring:
+            events = expand_events(events, time_min, time_max)
         return events
     except Exception as e:
-        print(f"An error occurred: {e}")
+        if raise_errors:
+            raise
+        logger.error(f"Could not list events: {e}")
         return []
     
-def delete_event(service, event_id):
-    '''Delete an event from the user's primary calendar.'''
+def delete_event(service, event_id, user_id=None):
+    '''Delete an event from the user's primary calendar, and from the database when the user is given.
+    Returns False if the event could not be deleted.'''
     try:
-        service.events().delete(calendarId='primary', eventId=event_id).execute()
+        call('calendar', service.events().delete(calendarId='primary', eventId=event_id).execute, key=user_id)
         # Also delete the event from the database
-        delete_event(event_id)
-        print(f"Event {event_id} deleted.")
+        if user_id is not None:
+            delete_event_by_google_id(user_id, event_id)
+        logger.info(f"Event {event_id} deleted.")
+        return True
     except Exception as e:
-        print(f"An error occurred: {e}")    
+        logger.error(f"Could not delete event {event_id}: {e}")    
+        return False
         
-def update_event(service, event_id, updated_event):
-    '''Update an existing event in the user's primary calendar.'''
+def update_event(service, event_id, updated_event, user_id=None):
+    '''Update an existing event in the user's primary calendar, and in the database when the user is given.'''
     try:
-        updated_event = service.events().patch(calendarId='primary', eventId=event_id, body=updated_event).execute()
+        updated_event = call('calendar', service.events().patch(calendarId='primary', eventId=event_id, body=updated_event).execute, key=user_id)
         # Also update the event in the database
-        update_event_in_db(
-            event_id=event_id,
-            title=updated_event.get('summary'),
-            start_time=updated_event['start']['dateTime'],
-            end_time=updated_event['end']['dateTime'],
-            description=updated_event.get('description'),
-            location=updated_event.get('location')
-        )
-        print(f"Event updated: {updated_event.get('htmlLink')}")
+        if user_id is not None:
+            update_event_by_google_id(
+                user_id=user_id,
+                google_event_id=event_id,
+                etag=updated_event.get('etag'),
+                title=updated_event.get('summary'),
+                start_time=updated_event['start'].get('dateTime', updated_event['start'].get('date')),
+                end_time=updated_event['end'].get('dateTime', updated_event['end'].get('date')),
+                description=updated_event.get('description'),
+                location=updated_event.get('location')
+            )
+        logger.info(f"Event updated: {updated_event.get('id')}")
         return updated_event
     except Exception as e:
-        print(f"An error occurred: {e}")
+        logger.error(f"Could not update event {event_id}: {e}")
         return None        
\ No newline at end of file
@@ -0,0 +1,147 @@
+from DB import get_created_events
+from Handlers.Calendar_API import to_timestamp
+from bisect import bisect_left
+from collections import OrderedDict
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Intervals that ended longer ago than this can't conflict with anything the user creates, they are dropped
+BUSY_HISTORY_SECONDS = int(os.getenv("BUSY_HISTORY_SECONDS", str(24 * 3600)))
+# Intervals kept per user, past this the ones starting latest are dropped
+BUSY_INDEX_MAX_INTERVALS = int(os.getenv("BUSY_INDEX_MAX_INTERVALS", "20000"))
+# Users whose index is kept in memory, the least recently used is rebuilt from the database when needed again
+BUSY_INDEX_MAX_USERS = int(os.getenv("BUSY_INDEX_MAX_USERS", "10000"))
+
+# user_id -> BusyIndex, built lazily from the created_events table, least recently used first
+_user_indexes = OrderedDict()
+
+
+class BusyIndex:
+    """Sorted array of a user's busy intervals, used to find overlaps without calling the Calendar API."""
+
+    def __init__(self, intervals=()):
+        self._set(sorted(intervals))
+
+    def _set(self, intervals):
+        # Parallel lists sorted by start time: starts[i] is the start of intervals[i]
+        self.intervals = intervals
+        self.starts = [interval[0] for interval in self.intervals]
+        # Longest interval kept, bounds how far back an overlapping interval can start
+        self.max_duration = max((end - start for start, end, _ in self.intervals), default=0)
+
+    def add(self, start, end, title):
+        """Add an interval given as unix timestamps."""
+        i = bisect_left(self.starts, start)
+        self.starts.insert(i, start)
+        self.intervals.insert(i, (start, end, title))
+        self.max_duration = max(self.max_duration, end - start)
+        if len(self.intervals) > BUSY_INDEX_MAX_INTERVALS:
+            self.prune(time.time() - BUSY_HISTORY_SECONDS, BUSY_INDEX_MAX_INTERVALS)
+
+    def prune(self, ended_before, max_intervals=None):
+        """Drop the intervals that ended before the given timestamp, then the latest ones past max_intervals.
+        Returns how many were dropped"""
+        kept = [interval for interval in self.intervals if interval[1] >= ended_before]
+        if max_intervals is not None and len(kept) > max_intervals:
+            # The soonest events are the ones conflict checks hit, the furthest in the future go first
+            kept = kept[:max_intervals]
+        dropped = len(self.intervals) - len(kept)
+        if dropped:
+            self._set(kept)
+        return dropped
+
+    def remove(self, start, end, title):
+        """Remove an interval, returning False if it isn't in the index."""
+        i = bisect_left(self.starts, start)
+        while i < len(self.starts) and self.starts[i] == start:
+            if self.intervals[i] == (start, end, title):
+                del self.starts[i]
+                del self.intervals[i]
+                return True
+            i += 1
+        return False
+
+    def overlapping(self, start, end):
+        """Return the intervals that overlap [start, end)."""
+        lo = bisect_left(self.starts, start - self.max_duration)
+        hi = bisect_left(self.starts, end)
+        return [interval for interval in self.intervals[lo:hi] if interval[1] > start]
+
+    def nearest_free_slot(self, start, end):
+        """Return the free slot of the same length closest to [start, end), before or after it."""
+        duration = end - start
+        # Walk forward past each conflict until a gap is long enough
+        later = start
+        conflicts = self.overlapping(later, later + duration)
+        while conflicts:
+            later = max(interval[1] for interval in conflicts)
+            conflicts = self.overlapping(later, later + duration)
+        # Walk backward the same way
+        earlier = start
+        conflicts = self.overlapping(earlier, earlier + duration)
+        while conflicts:
+            earlier = min(interval[0] for interval in conflicts) - duration
+            conflicts = self.overlapping(earlier, earlier + duration)
+        if start - earlier < later - start:
+            return earlier, earlier + duration
+        return later, later + duration
+
+
+def _interval(start_time, end_time):
+    """Convert ISO start and end times to a (start, end) pair of timestamps, or None if they can't be parsed."""
+    try:
+        start = to_timestamp(start_time)
+        end = to_timestamp(end_time)
+    except (TypeError, ValueError):
+        return None
+    # Zero-length events still block their start time
+    return start, max(end, start + 1)
+
+def get_busy_index(user_id):
+    """Return the user's busy index, building it from the database on first use."""
+    index = _user_indexes.get(user_id)
+    if index is not None:
+        _user_indexes.move_to_end(user_id)
+        return index
+    ended_before = time.time() - BUSY_HISTORY_SECONDS
+    intervals = []
+    for event in get_created_events(user_id):
+        interval = _interval(event['start_time'], event['end_time'])
+        if interval and interval[1] >= ended_before:
+            intervals.append((*interval, event['title']))
+    index = BusyIndex(intervals)
+    index.prune(ended_before, BUSY_INDEX_MAX_INTERVALS)
+    _user_indexes[user_id] = index
+    if len(_user_indexes) > BUSY_INDEX_MAX_USERS:
+        _user_indexes.popitem(last=False)
+    return index
+
+def has_busy_index(user_id):
+    """Return True if the user's busy index was already built, an index built later reads the database anyway."""
+    return user_id in _user_indexes
+
+def record_busy_interval(user_id, title, start_time, end_time):
+    """Add a created or updated event to the user's busy index."""
+    interval = _interval(start_time, end_time)
+    if interval:
+        get_busy_index(user_id).add(*interval, title)
+
+def forget_busy_interval(user_id, title, start_time, end_time):
+    """Remove a deleted or moved event from the user's busy index."""
+    interval = _interval(start_time, end_time)
+    if interval:
+        get_busy_index(user_id).remove(*interval, title)
+
+def find_conflicts(user_id, start_time, end_time):
+    """Return the user's events overlapping the given ISO times, and the nearest free slot if there are any."""
+    interval = _interval(start_time, end_time)
+    if interval is None:
+        return [], None
+    index = get_busy_index(user_id)
+    conflicts = index.overlapping(*interval)
+    if not conflicts:
+        return [], None
+    return conflicts, index.nearest_free_slot(*interval)
@@ -0,0 +1,71 @@
+from Handlers.Calendar_API import authenticate_user, list_events, to_timestamp
+from datetime import datetime, timedelta, timezone
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Days before and after now that are prefetched while the model is parsing the message
+PREFETCH_DAYS = int(os.getenv("PREFETCH_DAYS", "7"))
+# Largest page the Calendar API returns, a full page means the window may be truncated
+PREFETCH_MAX_RESULTS = 2500
+
+
+class CalendarContext:
+    """A user's Calendar service and the events of a window around now, fetched ahead of time."""
+
+    def __init__(self, service, window_start=None, window_end=None, events=None):
+        self.service = service
+        self.window_start = window_start
+        self.window_end = window_end
+        # None when the prefetch failed or was truncated, callers must then ask the API
+        self.events = events
+
+    def events_in_range(self, time_min, time_max):
+        """Return the prefetched events overlapping [time_min, time_max], like list_events would,
+        or None if the range isn't fully covered by the prefetched window"""
+        if self.events is None or not time_min or not time_max:
+            return None
+        try:
+            range_start = to_timestamp(time_min)
+            range_end = to_timestamp(time_max)
+        except ValueError:
+            return None
+        if range_start < self.window_start or range_end > self.window_end:
+            return None
+        events = []
+        # Recurring events were expanded into instances for the whole window by list_events
+        for event in self.events:
+            try:
+                if to_timestamp(event['start']) < range_end and to_timestamp(event['end']) > range_start:
+                    events.append(event)
+            except (TypeError, ValueError):
+                continue
+        return events
+
+
+def prefetch_calendar(user_id):
+    """Authenticate the user and list the events around now. Runs in a worker thread."""
+    service = authenticate_user(user_id)
+    if not service:
+        return CalendarContext(service)
+    now = datetime.now(timezone.utc)
+    window_start = now - timedelta(days=PREFETCH_DAYS)
+    window_end = now + timedelta(days=PREFETCH_DAYS)
+    try:
+        events = list_events(service, max_results=PREFETCH_MAX_RESULTS, time_min=window_start.isoformat(),
+                             time_max=window_end.isoformat(), raise_errors=True, user_id=user_id)
+    except Exception as e:
+        logger.warning(f"Calendar prefetch failed for user {user_id}: {e}")
+        return CalendarContext(service)
+    if len(events) >= PREFETCH_MAX_RESULTS:
+        return CalendarContext(service)
+    return CalendarContext(service, window_start.timestamp(), window_end.timestamp(), events)
+
+def list_events_prefetched(calendar_context, time_min=None, time_max=None, service=None, user_id=None):
+    """List the events in a range, from the prefetched window when it covers the range and from the API otherwise.
+    `service` overrides the prefetched service, for callers running concurrently."""
+    events = calendar_context.events_in_range(time_min, time_max)
+    if events is None:
+        events = list_events(service or calendar_context.service, max_results=9999, time_min=time_min, time_max=time_max, user_id=user_id)
+    return events
@@ -0,0 +1,203 @@
+from DB import claim_processed_update, release_processed_update
+from Handlers.Calendar_API import list_events
+from Handlers.resilience import call, call_async
+from Handlers.token_refresher import token_path, save_credentials, get_tracked_credentials
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+import asyncio
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+SCOPES = ['https://www.googleapis.com/auth/calendar']
+# Unsolicited messages, so the digest has to be switched on
+DIGEST_ENABLED = os.getenv("DIGEST_ENABLED", "false").lower() == "true"
+# Local hour the digest is sent at, users whose morning has passed by more than the window get none that day
+DIGEST_HOUR = int(os.getenv("DIGEST_HOUR", "7"))
+DIGEST_WINDOW_HOURS = 3
+# Users handled at once, on threads of their own so a run never holds the workers interactive handlers use.
+# Calendar and Telegram calls are paced by the resilience layer's rates, more threads would only wait there
+DIGEST_CONCURRENCY = int(os.getenv("DIGEST_CONCURRENCY", "8"))
+# The job runs this often and only sends to users whose digest hour has come, which staggers sends by time zone
+DIGEST_INTERVAL_SECONDS = int(os.getenv("DIGEST_INTERVAL_SECONDS", "900"))
+# Calendar time zone of each user, kept across restarts so staggering doesn't need a Calendar call per user
+DIGEST_TIMEZONE_FILE = os.getenv("DIGEST_TIMEZONE_FILE", "timezones.json")
+# A user whose digest failed is retried after this long, so a revoked token isn't retried every tick
+DIGEST_RETRY_SECONDS = 3600
+# Failed users listed in the run report
+REPORT_MAX_FAILURES = 20
+
+# User ID (as text) -> IANA time zone
+_timezones = None
+# User ID -> time before which a failed user is skipped
+_retry_after = {}
+_calendar_document = None
+_executor = None
+_running = False
+
+
+def _load_timezones():
+    """Return the cached time zone of every user, read from DIGEST_TIMEZONE_FILE once."""
+    global _timezones
+    if _timezones is None:
+        try:
+            with open(DIGEST_TIMEZONE_FILE) as timezone_file:
+                _timezones = json.load(timezone_file)
+        except (OSError, ValueError):
+            _timezones = {}
+    return _timezones
+
+def _save_timezones():
+    """Write the time zone cache, replacing the file in one step so a crash never leaves half of it."""
+    temp_path = f"{DIGEST_TIMEZONE_FILE}.tmp"
+    with open(temp_path, 'w') as timezone_file:
+        json.dump(_timezones, timezone_file)
+    os.replace(temp_path, DIGEST_TIMEZONE_FILE)
+
+def connected_users():
+    """Return the IDs of the users with a token file, as the integer Telegram IDs the rest of the bot uses."""
+    if not os.path.isdir('tokens'):
+        return []
+    with os.scandir('tokens') as entries:
+        names = [entry.name[:-len('.json')] for entry in entries if entry.name.endswith('.json')]
+    return [int(name) if name.isdigit() else name for name in names]
+
+def _build_service(creds):
+    """Build a Calendar service from the bundled discovery document, parsed once for all users."""
+    global _calendar_document
+    if _calendar_document is None:
+        _calendar_document = json.loads(get_static_doc('calendar', 'v3'))
+    return build_from_document(_calendar_document, credentials=creds)
+
+def _load_credentials(user_id):
+    """Return the user's credentials without ever starting an interactive login.
+    Credentials loaded only for the digest aren't tracked, the background refresher is for users who are chatting"""
+    creds = get_tracked_credentials(user_id)
+    if creds is None:
+        creds = Credentials.from_authorized_user_file(token_path(user_id), SCOPES)
+        if not creds.valid:
+            if not (creds.expired and creds.refresh_token):
+                raise ValueError("token can't be refreshed, the user has to /connect again")
+            creds.refresh(Request())
+            save_credentials(user_id, creds)
+    return creds
+
+async def _run_in_digest_thread(fn, *args):
+    """Run blocking work on the digest's own threads, created on first use."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(DIGEST_CONCURRENCY, thread_name_prefix='digest')
+    return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+
+def _digest_key(user_id, day):
+    return f"digest:{user_id}:{day.isoformat()}"
+
+def _format_digest(day, events, tz):
+    """Format the agenda of a day in the user's time zone."""
+    lines = [f"☀️ Your agenda for {day:%A, %d %B}:"]
+    for event in events:
+        if len(event['start']) == 10:
+            lines.append(f"• All day: {event['summary']}")
+            continue
+        start = datetime.fromisoformat(event['start'].replace('Z', '+00:00')).astimezone(tz)
+        end = datetime.fromisoformat(event['end'].replace('Z', '+00:00')).astimezone(tz)
+        lines.append(f"• {start:%H:%M}–{end:%H:%M} {event['summary']}" + (f" ({event['location']})" if event['location'] else ''))
+    return "\n".join(lines)
+
+def _prepare_digest(user_id, now):
+    """Build the user's digest if their digest hour has come. Runs in a worker thread.
+    Returns (claim key, text) with an empty text for an empty day, or None if it isn't due or was already sent"""
+    timezones = _load_timezones()
+    time_zone = timezones.get(str(user_id))
+    creds = None
+    if time_zone is None:
+        creds = _load_credentials(user_id)
+        settings = call('calendar', _build_service(creds).settings().get(setting='timezone').execute, key=user_id)
+        time_zone = timezones[str(user_id)] = settings.get('value', 'UTC')
+    tz = ZoneInfo(time_zone)
+    local_now = now.astimezone(tz)
+    if not DIGEST_HOUR <= local_now.hour < DIGEST_HOUR + DIGEST_WINDOW_HOURS:
+        return None
+    # Claimed before the Calendar call so a restart or an overlapping run never sends twice
+    digest_key = _digest_key(user_id, local_now.date())
+    if not claim_processed_update(digest_key, int(time.time()), 0):
+        return None
+    try:
+        service = _build_service(creds or _load_credentials(user_id))
+        day_start = datetime.combine(local_now.date(), datetime.min.time(), tz)
+        events = list_events(service, max_results=250, time_min=day_start.isoformat(),
+                             time_max=(day_start + timedelta(days=1)).isoformat(), raise_errors=True, user_id=user_id)
+    except Exception:
+        release_processed_update(digest_key)
+        raise
+    if not events:
+        return digest_key, ''
+    events.sort(key=lambda event: event['start'])
+    return digest_key, _format_digest(local_now.date(), events, tz)
+
+async def _send_digest(bot, user_id, now, semaphore, report):
+    """Prepare and send one user's digest, recording the outcome in the report."""
+    if _retry_after.get(user_id, 0) > time.time():
+        return
+    async with semaphore:
+        try:
+            digest = await _run_in_digest_thread(_prepare_digest, user_id, now)
+            if digest is None:
+                return
+            digest_key, text = digest
+            if not text:
+                report['empty'] += 1
+                return
+            try:
+                # Private chats share the user's ID
+                await call_async('telegram', bot.send_message, chat_id=user_id, text=text)
+            except Exception:
+                # Not sent, the next run within the user's window tries again
+                await _run_in_digest_thread(release_processed_update, digest_key)
+                raise
+            report['sent'] += 1
+        except Exception as e:
+            report['failed'][user_id] = str(e)
+            _retry_after[user_id] = time.time() + DIGEST_RETRY_SECONDS
+
+async def send_digests(bot, user_ids=None, now=None):
+    """Send the digest to every connected user whose digest hour has come, returns a report of the run."""
+    started = time.perf_counter()
+    now = now or datetime.now(timezone.utc)
+    user_ids = connected_users() if user_ids is None else user_ids
+    timezones_before = len(_load_timezones())
+    report = {'users': len(user_ids), 'sent': 0, 'empty': 0, 'failed': {}}
+    semaphore = asyncio.Semaphore(DIGEST_CONCURRENCY)
+    await asyncio.gather(*(_send_digest(bot, user_id, now, semaphore, report) for user_id in user_ids))
+    if len(_load_timezones()) != timezones_before:
+        await _run_in_digest_thread(_save_timezones)
+    report['seconds'] = time.perf_counter() - started
+    return report
+
+async def digest_job(context):
+    """JobQueue callback that sends the morning digests that are due and logs the run."""
+    global _running
+    # A slow run must not overlap with the next tick
+    if _running:
+        return
+    _running = True
+    try:
+        report = await send_digests(context.bot)
+    finally:
+        _running = False
+    failed = report['failed']
+    if report['sent'] or report['empty'] or failed:
+        logger.info(f"Digest run over {report['users']} user(s) in {report['seconds']:.1f}s: "
+                    f"{report['sent']} sent, {report['empty']} empty day(s), {len(failed)} failed")
+    for user_id, error in list(failed.items())[:REPORT_MAX_FAILURES]:
+        logger.warning(f"Digest failed for user {user_id}: {error}")
+    if len(failed) > REPORT_MAX_FAILURES:
+        logger.warning(f"Digest failed for {len(failed) - REPORT_MAX_FAILURES} more user(s)")
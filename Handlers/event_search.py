@@ -0,0 +1,143 @@
+from collections import OrderedDict, defaultdict
+import os
+import re
+
+# Matches scoring below this are not considered the same event
+MIN_MATCH_SCORE = 0.35
+# Candidates scoring within this margin of the best one are ambiguous
+AMBIGUITY_MARGIN = 0.1
+# Weight of the title trigram similarity, the rest goes to shared words
+TRIGRAM_WEIGHT = 0.6
+# Matches found only in the description are worth less than title matches
+DESCRIPTION_WEIGHT = 0.5
+
+# Users whose index is kept in memory, the least recently used is rebuilt from their next listing
+SEARCH_INDEX_MAX_USERS = int(os.getenv("SEARCH_INDEX_MAX_USERS", "10000"))
+
+# user_id -> EventSearchIndex, least recently used first
+_user_indexes = OrderedDict()
+
+
+def _tokens(text):
+    """Split text into lowercase words."""
+    return re.findall(r'\w+', (text or '').lower())
+
+def _trigrams(tokens):
+    """Return the padded character trigrams of a list of words."""
+    grams = set()
+    for token in tokens:
+        padded = f"  {token} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class EventSearchIndex:
+    """Trigram inverted index over a user's event titles and descriptions."""
+
+    def __init__(self):
+        # event_id -> (title, description, title tokens, title trigrams, description trigrams)
+        self.documents = {}
+        # trigram -> ids of the events whose title or description contains it
+        self.postings = defaultdict(set)
+
+    def add(self, event_id, title, description=''):
+        """Index an event, replacing its previous entry if the text changed."""
+        document = self.documents.get(event_id)
+        if document and document[0] == title and document[1] == description:
+            return
+        self.remove(event_id)
+        title_tokens = set(_tokens(title))
+        title_grams = _trigrams(title_tokens)
+        description_grams = _trigrams(_tokens(description))
+        self.documents[event_id] = (title, description, title_tokens, title_grams, description_grams)
+        for gram in title_grams | description_grams:
+            self.postings[gram].add(event_id)
+
+    def remove(self, event_id):
+        """Drop an event from the index."""
+        document = self.documents.pop(event_id, None)
+        if document is None:
+            return
+        for gram in document[3] | document[4]:
+            ids = self.postings[gram]
+            ids.discard(event_id)
+            if not ids:
+                del self.postings[gram]
+
+    def sync(self, events):
+        """Index the events returned by list_events, dropping the ones the listing no longer has.
+        Only listed events are ever searched, so older entries would just be deleted events kept in memory"""
+        listed = {event['id'] for event in events}
+        for event_id in self.documents.keys() - listed:
+            self.remove(event_id)
+        for event in events:
+            self.add(event['id'], event.get('summary', ''), event.get('description', ''))
+
+    def search(self, query, event_ids=None, limit=5):
+        """Return up to `limit` (score, event_id) pairs ranked by similarity to the query,
+        optionally restricted to the given event ids"""
+        query_tokens = set(_tokens(query))
+        query_grams = _trigrams(query_tokens)
+        if not query_grams:
+            return []
+        # Count shared trigrams per candidate straight from the postings lists
+        candidates = defaultdict(int)
+        for gram in query_grams:
+            for event_id in self.postings.get(gram, ()):
+                if event_ids is None or event_id in event_ids:
+                    candidates[event_id] += 1
+        results = []
+        for event_id in candidates:
+            _, _, title_tokens, title_grams, description_grams = self.documents[event_id]
+            title_score = 0.0
+            if title_grams:
+                dice = 2 * len(query_grams & title_grams) / (len(query_grams) + len(title_grams))
+                shared_words = len(query_tokens & title_tokens) / min(len(query_tokens), len(title_tokens))
+                title_score = TRIGRAM_WEIGHT * dice + (1 - TRIGRAM_WEIGHT) * shared_words
+            description_score = DESCRIPTION_WEIGHT * len(query_grams & description_grams) / len(query_grams)
+            score = max(title_score, description_score)
+            if score >= MIN_MATCH_SCORE:
+                results.append((score, event_id))
+        results.sort(reverse=True)
+        return results[:limit]
+
+
+def get_search_index(user_id):
+    """Return the user's event search index, creating it on first use."""
+    index = _user_indexes.get(user_id)
+    if index is not None:
+        _user_indexes.move_to_end(user_id)
+        return index
+    index = _user_indexes[user_id] = EventSearchIndex()
+    if len(_user_indexes) > SEARCH_INDEX_MAX_USERS:
+        _user_indexes.popitem(last=False)
+    return index
+
+def forget_event(user_id, event_id):
+    """Drop a deleted event from the user's index."""
+    index = _user_indexes.get(user_id)
+    if index is not None:
+        index.remove(event_id)
+
+def match_events(user_id, query, events):
+    """Rank the given events (as returned by list_events) by how well they match the query.
+    Returns a list of (score, event) pairs, best first"""
+    index = get_search_index(user_id)
+    index.sync(events)
+    events_by_id = {event['id']: event for event in events}
+    return [(score, events_by_id[event_id]) for score, event_id in index.search(query, event_ids=events_by_id.keys())]
+
+def ambiguous_matches(matches, query):
+    """Return the matches that can't be told apart from the best one, or an empty list.
+    A match is a candidate when it scores within the margin of the best one or its title has every word of the
+    query, "meeting" fits "Team meeting" and "Meeting with Sarah" alike. A single title equal to the query wins"""
+    if len(matches) < 2:
+        return []
+    query_tokens = set(_tokens(query))
+    best_score = matches[0][0]
+    close = [(score, event) for score, event in matches
+             if best_score - score < AMBIGUITY_MARGIN or query_tokens <= set(_tokens(event.get('summary')))]
+    exact = [match for match in close if set(_tokens(match[1].get('summary'))) == query_tokens]
+    if len(exact) == 1:
+        return []
+    return close if len(close) > 1 else []
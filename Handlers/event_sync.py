@@ -0,0 +1,124 @@
+from DB import get_synced_users, get_synced_events, apply_event_sync
+from Handlers.busy_index import has_busy_index, record_busy_interval, forget_busy_interval
+from Handlers.resilience import call
+from Handlers.token_refresher import get_tracked_credentials
+from googleapiclient.discovery import build
+from datetime import datetime, timedelta, timezone
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+EVENT_SYNC_INTERVAL_SECONDS = int(os.getenv("EVENT_SYNC_INTERVAL_SECONDS", "900"))
+# How far back the first run after a restart looks for changes made outside the bot
+EVENT_SYNC_LOOKBACK_DAYS = int(os.getenv("EVENT_SYNC_LOOKBACK_DAYS", "7"))
+# Largest page the Calendar API returns
+EVENT_SYNC_PAGE_SIZE = 2500
+# Users reconciled at the same time, Calendar calls are further limited by the resilience layer's rates
+EVENT_SYNC_CONCURRENCY = int(os.getenv("EVENT_SYNC_CONCURRENCY", "8"))
+
+# User ID -> start of the last successful sync, changes since then are fetched next time
+_last_synced = {}
+
+
+def _event_time(time_dict):
+    return time_dict.get('dateTime', time_dict.get('date'))
+
+def _list_changes(service, updated_min, user_id):
+    """Yield every event of the primary calendar changed since updated_min, deleted ones included."""
+    page_token = None
+    while True:
+        result = call('calendar', service.events().list(
+            calendarId='primary', updatedMin=updated_min, showDeleted=True, singleEvents=False,
+            maxResults=EVENT_SYNC_PAGE_SIZE, pageToken=page_token).execute, key=user_id)
+        yield from result.get('items', [])
+        page_token = result.get('nextPageToken')
+        if not page_token:
+            return
+
+def reconcile_user(user_id, service):
+    """Bring the user's created_events rows in line with changes made in Google Calendar.
+    Returns the busy intervals to move as (old row, new row or None) pairs. Runs in a worker thread"""
+    local = get_synced_events(user_id)
+    if not local:
+        return []
+    started = datetime.now(timezone.utc)
+    updated_min = _last_synced.get(user_id, started - timedelta(days=EVENT_SYNC_LOOKBACK_DAYS))
+    updated = []
+    deleted_ids = []
+    changes = []
+    # Series with a changed or cancelled instance, rows are kept per series so the series is read again
+    series_ids = set()
+    seen_ids = set()
+
+    def compare(event):
+        row = local.get(event['id'])
+        # Only the events the bot created are compared, and only when Google reports a new version
+        if row is None or row['etag'] == event.get('etag'):
+            return
+        if event.get('status') == 'cancelled':
+            deleted_ids.append(event['id'])
+            changes.append((row, None))
+            return
+        new_row = {
+            'google_event_id': event['id'],
+            'etag': event.get('etag'),
+            'title': event.get('summary', 'No Title'),
+            'start_time': _event_time(event['start']),
+            'end_time': _event_time(event['end']),
+            'description': event.get('description'),
+            'location': event.get('location'),
+        }
+        updated.append(new_row)
+        changes.append((row, new_row))
+
+    for event in _list_changes(service, updated_min.isoformat(), user_id):
+        seen_ids.add(event['id'])
+        # Instance ids look like {series id}_{start} and never match a row themselves
+        if event['id'] not in local and event.get('recurringEventId') in local:
+            series_ids.add(event['recurringEventId'])
+            continue
+        compare(event)
+    for series_id in series_ids - seen_ids:
+        try:
+            compare(call('calendar', service.events().get(calendarId='primary', eventId=series_id).execute, key=user_id))
+        except Exception as e:
+            logger.warning(f"Could not read recurring event {series_id} of user {user_id}: {e}")
+    # All of a user's changes are written in one transaction
+    apply_event_sync(user_id, updated, deleted_ids)
+    _last_synced[user_id] = started
+    if updated or deleted_ids:
+        logger.info(f"Synced user {user_id}: {len(updated)} updated, {len(deleted_ids)} deleted")
+    return changes
+
+def _reconcile_user_with_tracked_credentials(user_id):
+    """Reconcile a user whose credentials the token refresher keeps fresh, never starting an interactive login."""
+    creds = get_tracked_credentials(user_id)
+    if creds is None:
+        return []
+    service = build('calendar', 'v3', credentials=creds)
+    return reconcile_user(user_id, service)
+
+async def _reconcile_one(user_id, semaphore):
+    """Reconcile one user and move their busy intervals along."""
+    async with semaphore:
+        try:
+            changes = await asyncio.to_thread(_reconcile_user_with_tracked_credentials, user_id)
+        except Exception as e:
+            logger.warning(f"Event sync failed for user {user_id}: {e}")
+            return
+    if not has_busy_index(user_id):
+        return
+    # The busy index is only touched from the event loop
+    for old, new in changes:
+        forget_busy_interval(user_id, old['title'], old['start_time'], old['end_time'])
+        if new is not None:
+            record_busy_interval(user_id, new['title'], new['start_time'], new['end_time'])
+
+async def reconcile_events_job(context=None):
+    """JobQueue callback that reconciles every user with synced events and valid credentials."""
+    user_ids = await asyncio.to_thread(get_synced_users)
+    semaphore = asyncio.Semaphore(EVENT_SYNC_CONCURRENCY)
+    # Stored as text, the rest of the bot uses Telegram's integer IDs
+    await asyncio.gather(*(_reconcile_one(int(user_id) if user_id.isdigit() else user_id, semaphore) for user_id in user_ids))
@@ -0,0 +1,67 @@
+from DB import iter_user_history, iter_created_events
+import argparse
+import csv
+import json
+import os
+import sys
+
+EXPORT_FORMATS = ('jsonl', 'csv')
+# Table name -> (row iterator, columns in export order)
+EXPORT_TABLES = {
+    'history': (iter_user_history, ['msg_id', 'user_id', 'role', 'message', 'timestamp']),
+    'events': (iter_created_events, ['event_id', 'user_id', 'title', 'start_time', 'end_time', 'description', 'location']),
+}
+
+
+def write_rows(rows, columns, output, fmt='jsonl'):
+    """Stream rows to an open text file as JSON lines or CSV, returns the number of rows written."""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    count = 0
+    if fmt == 'csv':
+        writer = csv.DictWriter(output, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in rows:
+            output.write(json.dumps(row, ensure_ascii=False) + '\n')
+            count += 1
+    return count
+
+def export_table(table, path, fmt='jsonl', user_id=None):
+    """Export one table to a file, for a single user or for everyone, returns the number of rows written."""
+    iterate, columns = EXPORT_TABLES[table]
+    with open(path, 'w', encoding='utf-8', newline='') as output:
+        return write_rows(iterate(user_id=user_id), columns, output, fmt)
+
+def export_user_data(user_id, directory, fmt='jsonl'):
+    """Export every table for a user into a directory, returns the paths of the written files."""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for table in EXPORT_TABLES:
+        path = os.path.join(directory, f"{table}-{user_id}.{fmt}")
+        export_table(table, path, fmt, user_id=user_id)
+        paths.append(path)
+    return paths
+
+
+def main():
+    """Export a table from the command line, e.g. python -m Handlers.export history out.csv --format csv"""
+    parser = argparse.ArgumentParser(description="Export bot data as JSON lines or CSV")
+    parser.add_argument('table', choices=EXPORT_TABLES)
+    parser.add_argument('output', help="output file, '-' for stdout")
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='jsonl')
+    parser.add_argument('--user', help="only export this user's rows")
+    args = parser.parse_args()
+    if args.output == '-':
+        iterate, columns = EXPORT_TABLES[args.table]
+        count = write_rows(iterate(user_id=args.user), columns, sys.stdout, args.format)
+    else:
+        count = export_table(args.table, args.output, args.format, user_id=args.user)
+    print(f"Exported {count} row(s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
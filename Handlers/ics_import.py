@@ -0,0 +1,234 @@
+from DB import save_created_events
+from Handlers.Calendar_API import create_event_dict, new_event_id
+from Handlers.busy_index import record_busy_interval
+from Handlers.resilience import call, _error_status, _rate_limit_reason
+from datetime import date, datetime, timedelta
+import asyncio
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+# Google accepts at most 50 requests per batch
+IMPORT_BATCH_SIZE = 50
+# Minimum time between two batches. The per-user Calendar rate limit of call() spaces them out further,
+# at 10 events per second a 50-event batch goes out every 5 seconds and 5,000 events take about 8 minutes
+IMPORT_BATCH_INTERVAL_SECONDS = 1.0
+# Attempts per event before it is reported as failed
+IMPORT_MAX_ATTEMPTS = 3
+# HTTP statuses worth retrying in a later batch, 403s only when they report a rate limit
+RETRYABLE_STATUSES = {429, 500, 502, 503}
+
+_DURATION_PATTERN = re.compile(r'^([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+
+
+def _unescape(value):
+    """Undo iCalendar text escaping."""
+    return re.sub(r'\\([\\;,nN])', lambda m: '\n' if m.group(1) in 'nN' else m.group(1), value)
+
+def _unfold(lines):
+    """Join iCalendar folded lines, a line starting with a space or tab continues the previous one."""
+    current = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current:
+        yield current
+
+def _parse_line(line):
+    """Split a content line into (name, params, value)."""
+    head, _, value = line.partition(':')
+    name, *raw_params = head.split(';')
+    params = {}
+    for raw_param in raw_params:
+        key, _, param_value = raw_param.partition('=')
+        params[key.upper()] = param_value.strip('"')
+    return name.upper(), params, value
+
+def iter_ics_events(lines):
+    """Yield the properties of each VEVENT in an iCalendar stream without loading the whole file.
+    Each event is a dict of property name -> list of (params, value)"""
+    event = None
+    depth = 0
+    for line in _unfold(lines):
+        name, params, value = _parse_line(line)
+        if name == 'BEGIN':
+            if value.upper() == 'VEVENT':
+                event = {}
+            elif event is not None:
+                # Nested components such as VALARM are skipped
+                depth += 1
+        elif name == 'END':
+            if value.upper() == 'VEVENT' and event is not None:
+                yield event
+                event = None
+            elif event is not None and depth:
+                depth -= 1
+        elif event is not None and not depth:
+            event.setdefault(name, []).append((params, value))
+
+def _parse_ics_time(params, value):
+    """Convert an iCalendar date or datetime to a Calendar API start/end dict."""
+    value = value.strip()
+    if params.get('VALUE') == 'DATE' or len(value) == 8:
+        return {'date': datetime.strptime(value, '%Y%m%d').date().isoformat()}
+    utc = value.endswith('Z')
+    parsed = datetime.strptime(value.rstrip('Z'), '%Y%m%dT%H%M%S')
+    time_dict = {'dateTime': parsed.isoformat() + ('Z' if utc else '')}
+    # Floating times are treated as UTC, like the events the bot creates
+    time_dict['timeZone'] = 'UTC' if utc else params.get('TZID', 'UTC')
+    return time_dict
+
+def _parse_duration(value):
+    """Convert an iCalendar DURATION such as PT1H30M to a timedelta."""
+    match = _DURATION_PATTERN.match(value.strip())
+    if not match:
+        return None
+    sign, weeks, days, hours, minutes, seconds = match.groups()
+    duration = timedelta(weeks=int(weeks or 0), days=int(days or 0), hours=int(hours or 0),
+                         minutes=int(minutes or 0), seconds=int(seconds or 0))
+    return -duration if sign == '-' else duration
+
+def _shift(time_dict, delta):
+    """Return a start/end dict moved by delta."""
+    if 'date' in time_dict:
+        return {'date': (date.fromisoformat(time_dict['date']) + delta).isoformat()}
+    utc = time_dict['dateTime'].endswith('Z')
+    shifted = datetime.fromisoformat(time_dict['dateTime'].rstrip('Z')) + delta
+    return {'dateTime': shifted.isoformat() + ('Z' if utc else ''), 'timeZone': time_dict['timeZone']}
+
+def ics_event_to_payload(properties):
+    """Convert parsed VEVENT properties to a create_event_dict payload, or None if it has no start."""
+    def first(name, default=''):
+        values = properties.get(name)
+        return values[0][1] if values else default
+
+    if 'DTSTART' not in properties or first('STATUS').upper() == 'CANCELLED':
+        return None
+    try:
+        start = _parse_ics_time(*properties['DTSTART'][0])
+        if 'DTEND' in properties:
+            end = _parse_ics_time(*properties['DTEND'][0])
+        else:
+            duration = _parse_duration(first('DURATION')) if 'DURATION' in properties else None
+            # Without an end, all-day events last one day and timed events one hour
+            end = _shift(start, duration or (timedelta(days=1) if 'date' in start else timedelta(hours=1)))
+    except ValueError:
+        return None
+    event = create_event_dict(
+        title=_unescape(first('SUMMARY', 'No Title')),
+        start_time=start.get('dateTime'),
+        end_time=end.get('dateTime'),
+        description=_unescape(first('DESCRIPTION')),
+        location=_unescape(first('LOCATION')),
+    )
+    event['start'] = start
+    event['end'] = end
+    # Imported events keep the calendar's default reminders instead of the bot's email and popup
+    event['reminders'] = {'useDefault': True}
+    recurrence = [f"{name}{''.join(f';{k}={v}' for k, v in params.items())}:{value}"
+                  for name in ('RRULE', 'EXDATE', 'RDATE') for params, value in properties.get(name, [])]
+    if recurrence:
+        event['recurrence'] = recurrence
+    return event
+
+def _insert_batch(service, payloads, user_id):
+    """Insert a batch of events in one HTTP request.
+    Returns the created events and the (payload, retryable) pairs that failed"""
+    created = []
+    failed = []
+
+    def callback(request_id, response, exception):
+        payload = payloads[int(request_id)]
+        if exception is None:
+            created.append(response)
+        elif _error_status(exception) == 409:
+            # The ID is taken, an earlier attempt of this batch already created the event
+            created.append(payload)
+        else:
+            retryable = _error_status(exception) in RETRYABLE_STATUSES or _rate_limit_reason(exception) is not None
+            failed.append((payload, retryable))
+
+    batch = service.new_batch_http_request(callback=callback)
+    for i, payload in enumerate(payloads):
+        # A fixed ID makes the batch safe to send again when a response is lost
+        payload.setdefault('id', new_event_id())
+        batch.add(service.events().insert(calendarId='primary', body=payload), request_id=str(i))
+    # One HTTP request that counts as one call per event against the quota
+    call('calendar', batch.execute, cost=len(payloads), key=user_id)
+    return created, failed
+
+def _event_time(time_dict):
+    """Return the dateTime or date of a start/end dict."""
+    return time_dict.get('dateTime', time_dict.get('date'))
+
+def _created_rows(user_id, created):
+    """Convert created events to created_events rows."""
+    return [{
+        'user_id': user_id,
+        'title': event.get('summary', 'No Title'),
+        'start_time': _event_time(event['start']),
+        'end_time': _event_time(event['end']),
+        'description': event.get('description'),
+        'location': event.get('location'),
+        'google_event_id': event.get('id'),
+        'etag': event.get('etag'),
+    } for event in created]
+
+async def import_ics_file(path, service, user_id, on_progress=None):
+    """Import every event of an .ics file into the user's primary calendar.
+    `on_progress(created, failed)` is awaited after each batch. Returns (created, failed) counts"""
+    created_count = 0
+    failed_count = 0
+    # (payload, attempts) waiting to be sent
+    pending = []
+    last_batch = 0.0
+
+    async def flush(payloads):
+        nonlocal created_count, failed_count, last_batch
+        # Space batches out to stay under the Calendar API quota
+        wait = IMPORT_BATCH_INTERVAL_SECONDS - (time.monotonic() - last_batch)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        last_batch = time.monotonic()
+        try:
+            created, failed = await asyncio.to_thread(_insert_batch, service, [payload for payload, _ in payloads], user_id)
+        except Exception as e:
+            logger.error(f"Batch insert failed for user {user_id}: {e}")
+            created, failed = [], [(payload, False) for payload, _ in payloads]
+        # The whole batch is recorded in one transaction
+        rows = _created_rows(user_id, created)
+        await asyncio.to_thread(save_created_events, rows)
+        for row in rows:
+            record_busy_interval(user_id, row['title'], row['start_time'], row['end_time'])
+        created_count += len(created)
+        attempts = {id(payload): tries for payload, tries in payloads}
+        for payload, retryable in failed:
+            tries = attempts[id(payload)] + 1
+            if retryable and tries < IMPORT_MAX_ATTEMPTS:
+                # Retried in a later batch, after the interval has passed
+                pending.append((payload, tries))
+            else:
+                failed_count += 1
+        if on_progress:
+            await on_progress(created_count, failed_count)
+
+    with open(path, encoding='utf-8', errors='replace') as ics_file:
+        for properties in iter_ics_events(ics_file):
+            payload = ics_event_to_payload(properties)
+            if payload is None:
+                continue
+            pending.append((payload, 0))
+            if len(pending) >= IMPORT_BATCH_SIZE:
+                batch, pending[:] = pending[:IMPORT_BATCH_SIZE], pending[IMPORT_BATCH_SIZE:]
+                await flush(batch)
+    while pending:
+        batch, pending[:] = pending[:IMPORT_BATCH_SIZE], pending[IMPORT_BATCH_SIZE:]
+        await flush(batch)
+    return created_count, failed_count
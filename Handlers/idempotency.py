@@ -0,0 +1,74 @@
+from DB import claim_processed_update, release_processed_update, prune_processed_updates
+from collections import OrderedDict
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# The same text from the same user within this many seconds is treated as a double send
+DUPLICATE_WINDOW_SECONDS = int(os.getenv("DUPLICATE_WINDOW_SECONDS", "30"))
+# How long update IDs are remembered, Telegram only redelivers updates that are at most a day old
+UPDATE_ID_TTL_SECONDS = 24 * 3600
+# Keys remembered in memory, older ones are still found in the database
+SEEN_UPDATES_SIZE = 10000
+PRUNE_INTERVAL_SECONDS = 3600
+
+# Outcomes of claim_update
+CLAIMED = 'claimed'
+REDELIVERED = 'redelivered'
+DUPLICATE = 'duplicate'
+
+# Update key -> time it was claimed, oldest first
+_seen = OrderedDict()
+# Claims and releases run in worker threads
+_seen_lock = threading.Lock()
+
+
+def _content_key(user_id, text):
+    digest = hashlib.sha256(f"{user_id}\0{text.strip()}".encode()).hexdigest()[:32]
+    return f"content:{digest}"
+
+def _claim(update_key, window):
+    """Claim a key unless it was claimed within the window, checking memory before the database."""
+    now = int(time.time())
+    with _seen_lock:
+        claimed_at = _seen.get(update_key)
+    if claimed_at is not None and claimed_at >= now - window:
+        return False
+    # The database catches what memory has evicted or another run of the bot processed
+    if not claim_processed_update(update_key, now, now - window):
+        return False
+    with _seen_lock:
+        _seen[update_key] = now
+        _seen.move_to_end(update_key)
+        if len(_seen) > SEEN_UPDATES_SIZE:
+            _seen.popitem(last=False)
+    return True
+
+def claim_update(update_id, user_id, text):
+    """Return CLAIMED if the update should be processed, REDELIVERED or DUPLICATE if it is a redelivery or a double send.
+    `text` is the message content compared for double sends, None to only check the update ID.
+    Call it before any model or Calendar call, the claim is what makes the later work happen once.
+    It commits to the database, so run it in a worker thread from the event loop"""
+    if not _claim(f"update:{update_id}", UPDATE_ID_TTL_SECONDS):
+        logger.info(f"Skipping redelivered update {update_id}")
+        return REDELIVERED
+    if text and not _claim(_content_key(user_id, text), DUPLICATE_WINDOW_SECONDS):
+        logger.info(f"Skipping duplicate message from user {user_id} in update {update_id}")
+        return DUPLICATE
+    return CLAIMED
+
+def release_update(user_id, text):
+    """Let the same content be processed again right away, after handling it failed."""
+    update_key = _content_key(user_id, text)
+    with _seen_lock:
+        _seen.pop(update_key, None)
+    release_processed_update(update_key)
+
+async def prune_processed_updates_job(context=None):
+    """JobQueue callback that deletes update keys too old to suppress anything."""
+    await asyncio.to_thread(prune_processed_updates, int(time.time()) - UPDATE_ID_TTL_SECONDS)
@@ -0,0 +1,147 @@
+from Handlers.resilience import call
+from collections import defaultdict, deque
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "meta-llama/llama-3-8b-instruct"
+# Candidate models per task, comma separated, the first one is preferred until there is latency data
+MODEL_ROUTES = {
+    'intent': [model.strip() for model in os.getenv("INTENT_MODELS", DEFAULT_MODEL).split(',') if model.strip()],
+    'chat': [model.strip() for model in os.getenv("CHAT_MODELS", DEFAULT_MODEL).split(',') if model.strip()],
+}
+# Time allowed for one model, retries included, before falling back to the next
+MODEL_TIMEOUT_SECONDS = float(os.getenv("MODEL_TIMEOUT_SECONDS", "30"))
+# Fire a second request at the next model when the first one is slower than its usual p95
+MODEL_HEDGING = os.getenv("MODEL_HEDGING", "false").lower() == "true"
+# Never hedge sooner than this, and use it until a model has enough samples for a p95
+MIN_HEDGE_DELAY_SECONDS = 1.0
+# Number of recent calls the rolling statistics are computed over
+STATS_WINDOW = 100
+# Samples needed before the p95 is trusted
+MIN_SAMPLES = 10
+# How much a model's error rate penalises its latency when ranking
+ERROR_PENALTY = 4
+
+
+class ModelStats:
+    """Rolling latency and error rate of one model."""
+
+    def __init__(self):
+        self.latencies = deque(maxlen=STATS_WINDOW)
+        self.outcomes = deque(maxlen=STATS_WINDOW)
+
+    def record(self, latency, ok):
+        if ok:
+            self.latencies.append(latency)
+        self.outcomes.append(ok)
+
+    def percentile(self, q):
+        """Return the q-th percentile latency, or None without samples."""
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+
+    def score(self):
+        """Lower is better, models without samples score 0 so they get tried."""
+        if not self.outcomes:
+            return 0.0
+        median = self.percentile(0.5)
+        if median is None:
+            # Only failures so far, rank it as if every call timed out
+            median = MODEL_TIMEOUT_SECONDS
+        return median * (1 + ERROR_PENALTY * self.error_rate())
+
+
+_model_stats = defaultdict(ModelStats)
+
+
+def rank_models(task):
+    """Return the task's candidate models, fastest and most reliable first."""
+    candidates = MODEL_ROUTES.get(task) or [DEFAULT_MODEL]
+    # sorted() is stable, so configuration order breaks ties
+    return sorted(candidates, key=lambda model: _model_stats[model].score())
+
+def get_model_stats():
+    """Return a snapshot of the rolling statistics of every model used so far."""
+    return {model: {
+        'p50': stats.percentile(0.5),
+        'p95': stats.percentile(0.95),
+        'error_rate': stats.error_rate(),
+        'calls': len(stats.outcomes),
+    } for model, stats in _model_stats.items()}
+
+def _hedge_delay(model):
+    """Return how long to wait for a model before hedging."""
+    stats = _model_stats[model]
+    if len(stats.latencies) < MIN_SAMPLES:
+        return max(MIN_HEDGE_DELAY_SECONDS, MODEL_TIMEOUT_SECONDS / 4)
+    return max(MIN_HEDGE_DELAY_SECONDS, stats.percentile(0.95))
+
+async def log_model_stats(context=None):
+    """JobQueue callback that logs the rolling statistics of every model."""
+    for model, stats in get_model_stats().items():
+        logger.info(f"Model {model}: {stats}")
+
+def _call_model(client, model, messages):
+    """Call a model synchronously, recording its latency and outcome. Runs in a worker thread."""
+    started = time.perf_counter()
+    deadline = time.monotonic() + MODEL_TIMEOUT_SECONDS
+
+    def attempt():
+        # Each retry only gets what is left of the model's time
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"{model} did not answer within {MODEL_TIMEOUT_SECONDS:.0f}s")
+        return client.with_options(timeout=remaining, max_retries=0).chat.completions.create(model=model, messages=messages)
+
+    try:
+        # Retries are left to the resilience layer so they share its backoff and circuit breaker
+        response = call('openrouter', attempt, deadline=deadline)
+        content = response.choices[0].message.content
+    except Exception:
+        _model_stats[model].record(time.perf_counter() - started, False)
+        raise
+    _model_stats[model].record(time.perf_counter() - started, True)
+    return content
+
+def _start(client, model, messages):
+    """Start a model call in a worker thread."""
+    task = asyncio.create_task(asyncio.to_thread(_call_model, client, model, messages))
+    # Losing hedged requests may fail after nobody awaits them, retrieve the error so it isn't reported
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    return task
+
+async def complete(client, messages, task='chat'):
+    """Return the model's reply to the messages, routing to the best model for the task.
+    Falls back to the next model on error and, with MODEL_HEDGING, races a second model when the first is slow"""
+    models = rank_models(task)
+    last_error = None
+    i = 0
+    while i < len(models):
+        pending = {_start(client, models[i], messages)}
+        if MODEL_HEDGING and i + 1 < len(models):
+            done, _ = await asyncio.wait(pending, timeout=_hedge_delay(models[i]))
+            if not done:
+                logger.info(f"Model {models[i]} is slow for task {task}, hedging with {models[i + 1]}")
+                pending.add(_start(client, models[i + 1], messages))
+                i += 1
+        i += 1
+        # Take whichever answer arrives first
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for finished in done:
+                if finished.exception() is None:
+                    return finished.result()
+                last_error = finished.exception()
+                logger.warning(f"Model call failed for task {task}: {last_error}")
+    raise last_error
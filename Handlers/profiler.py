@@ -0,0 +1,176 @@
+from collections import Counter
+from datetime import datetime, timezone
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Telegram user IDs allowed to run admin commands, comma separated
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").split(',') if user_id.strip().isdigit()}
+# Time between two stack samples, lower is more precise and costs more CPU while profiling
+PROFILE_SAMPLE_INTERVAL_SECONDS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_SECONDS", "0.005"))
+# Directory of the collapsed-stack files, one per profiling run
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Updates profiled when /profile gets no argument, and the longest a run may last
+PROFILE_DEFAULT_UPDATES = 50
+PROFILE_MAX_SECONDS = 600
+# Functions listed in the summary sent to the chat
+PROFILE_TOP_N = 15
+# Handler group of the update counter, after every other handler so an update is counted once it is fully handled
+PROFILE_HANDLER_GROUP = 100
+
+# Frames from files under this directory are the bot's own code
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_session = None
+
+
+def is_admin(user_id):
+    return user_id in ADMIN_USER_IDS
+
+
+class StackSampler:
+    """Samples the stacks of every thread from a background thread and counts them in collapsed form.
+    Only stacks that pass through the bot's own code are kept, so idle event loop and library threads are ignored"""
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        # Labels of the bot's own functions, for the summary
+        self.own_labels = set()
+        # Code object -> (label, is the bot's own code), labels are computed once per function
+        self.code_labels = {}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self.started = time.monotonic()
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling and wait for the sampler thread, returns the profiled duration in seconds."""
+        self.stop_event.set()
+        self.thread.join()
+        return time.monotonic() - self.started
+
+    def _label(self, code):
+        """Return 'file:function' for a code object, the file is relative to the bot's directory for the bot's own code."""
+        cached = self.code_labels.get(code)
+        if cached is None:
+            filename = code.co_filename
+            own = filename.startswith(_ROOT) and os.sep + 'site-packages' + os.sep not in filename
+            label = f"{os.path.relpath(filename, _ROOT) if own else os.path.basename(filename)}:{code.co_qualname}"
+            if own:
+                self.own_labels.add(label)
+            cached = self.code_labels[code] = (label, own)
+        return cached
+
+    def _run(self):
+        own_thread = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            self.samples += 1
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                labels = []
+                own_code = False
+                while frame is not None:
+                    label, own = self._label(frame.f_code)
+                    own_code = own_code or own
+                    labels.append(label)
+                    frame = frame.f_back
+                if own_code:
+                    # Collapsed stacks go from the root to the leaf
+                    self.stacks[';'.join(reversed(labels))] += 1
+
+
+class ProfileSession:
+    """A profiling run started by an admin, stopped after a number of updates or seconds."""
+
+    def __init__(self, chat_id, max_updates, max_seconds, trigger_update_id):
+        self.chat_id = chat_id
+        self.max_updates = max_updates
+        self.max_seconds = max_seconds
+        # The /profile command itself finishes after the run has started, it isn't counted
+        self.trigger_update_id = trigger_update_id
+        self.updates = 0
+        self.sampler = StackSampler()
+
+
+def parse_profile_args(args):
+    """Parse the /profile arguments: a number of updates or a duration such as 30s.
+    Returns (max_updates, max_seconds), raises ValueError on anything else"""
+    if not args:
+        return PROFILE_DEFAULT_UPDATES, PROFILE_MAX_SECONDS
+    value = args[0].lower()
+    if value.endswith('s') and value[:-1].isdigit():
+        return None, min(int(value[:-1]), PROFILE_MAX_SECONDS)
+    if value.isdigit() and int(value) > 0:
+        return int(value), PROFILE_MAX_SECONDS
+    raise ValueError(value)
+
+def start_profiling(chat_id, max_updates, max_seconds, trigger_update_id):
+    """Start sampling, returns False if a run is already in progress."""
+    global _session
+    if _session is not None:
+        return False
+    _session = ProfileSession(chat_id, max_updates, max_seconds, trigger_update_id)
+    _session.sampler.start()
+    logger.info(f"Profiling started for {max_updates or 'unlimited'} update(s), at most {max_seconds}s")
+    return True
+
+def write_collapsed_stacks(stacks, path):
+    """Write stacks in the collapsed format read by flamegraph.pl, speedscope and inferno."""
+    with open(path, 'w', encoding='utf-8') as output:
+        for stack, count in stacks.most_common():
+            output.write(f"{stack} {count}\n")
+
+def summarize(stacks, own_labels, seconds_per_sample, top_n=PROFILE_TOP_N):
+    """Return the bot's functions with the most samples, as (label, total seconds, self seconds) tuples.
+    Total counts the samples a function is anywhere on the stack, self only those where it is the innermost of the bot's frames"""
+    total = Counter()
+    own_self = Counter()
+    for stack, count in stacks.items():
+        labels = [label for label in stack.split(';') if label in own_labels]
+        for label in set(labels):
+            total[label] += count
+        if labels:
+            own_self[labels[-1]] += count
+    return [(label, count * seconds_per_sample, own_self[label] * seconds_per_sample) for label, count in total.most_common(top_n)]
+
+def stop_profiling():
+    """Stop the current run, write its collapsed stacks and return (chat_id, path, summary text), or None if none is running.
+    Blocks while the sampler thread finishes, run it in a worker thread from async code"""
+    global _session
+    session, _session = _session, None
+    if session is None:
+        return None
+    duration = session.sampler.stop()
+    stacks = session.sampler.stacks
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"profile-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.folded")
+    write_collapsed_stacks(stacks, path)
+    lines = [f"🔬 Profiled {session.updates} update(s) over {duration:.1f}s, {session.sampler.samples} samples"]
+    # Sampling drifts behind the nominal interval under load, the measured rate is used instead
+    seconds_per_sample = duration / max(1, session.sampler.samples)
+    for label, total, own in summarize(stacks, session.sampler.own_labels, seconds_per_sample):
+        lines.append(f"{total:7.2f}s total {own:7.2f}s self  {label}")
+    if len(lines) == 1:
+        lines.append("No samples in the bot's code")
+    logger.info(f"Profiling stopped, collapsed stacks written to {path}")
+    return session.chat_id, path, "\n".join(lines)
+
+def count_profiled_update(update_id):
+    """Count a fully handled update, returns True when the run has profiled enough updates."""
+    session = _session
+    if session is None or update_id == session.trigger_update_id:
+        return False
+    session.updates += 1
+    return session.max_updates is not None and session.updates >= session.max_updates
+
+def is_profiling():
+    return _session is not None
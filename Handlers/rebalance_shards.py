@@ -0,0 +1,45 @@
+from DB import DATABASE_SHARDS, acquire_database_lock, existing_shard_files, shard_files, get_misplaced_users, move_user_rows
+import argparse
+import sys
+
+
+def rebalance(dry_run=False):
+    """Move every user's rows to the shard DATABASE_SHARDS assigns them to, returns (users, rows) moved."""
+    users = 0
+    rows = 0
+    for source in existing_shard_files():
+        for user_id, target in get_misplaced_users(source).items():
+            print(f"{user_id}: {source} -> {target}", file=sys.stderr)
+            users += 1
+            if not dry_run:
+                rows += move_user_rows(user_id, source, target)
+    return users, rows
+
+def main():
+    """Rebalance shards from the command line after changing DATABASE_SHARDS, e.g. python -m Handlers.rebalance_shards
+    Stop every bot first: rows written while they move would be lost or duplicated, so the tool refuses to run
+    while a bot holds the database, and a bot started during the run refuses to start"""
+    parser = argparse.ArgumentParser(description=f"Move chat history and created events to their shard ({DATABASE_SHARDS} configured)")
+    parser.add_argument('--dry-run', action='store_true', help="only list the users that would move")
+    args = parser.parse_args()
+    try:
+        lock = acquire_database_lock(exclusive=True)
+    except RuntimeError as e:
+        print(f"Stop the bot before rebalancing: {e}", file=sys.stderr)
+        sys.exit(1)
+    try:
+        users, rows = rebalance(args.dry_run)
+    finally:
+        lock.close()
+    if args.dry_run:
+        print(f"{users} user(s) would move", file=sys.stderr)
+        return
+    print(f"Moved {rows} row(s) of {users} user(s)", file=sys.stderr)
+    # Files of shards past the configured count are empty now and can be deleted
+    for path in existing_shard_files():
+        if path not in shard_files():
+            print(f"{path} is no longer used", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
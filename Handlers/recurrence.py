@@ -0,0 +1,121 @@
+from dateutil.rrule import rrulestr
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Window expanded when a listing has no end, so endless series stay bounded
+DEFAULT_EXPANSION_DAYS = int(os.getenv("RECURRENCE_EXPANSION_DAYS", "30"))
+# Number of (event, window) expansions kept in memory
+EXPANSION_CACHE_SIZE = 4096
+
+# (event id, event version, window start day, window end day) -> tuple of occurrence starts
+_expansion_cache = OrderedDict()
+
+
+def _parse_time(value, tz):
+    """Parse an event start/end into a datetime, dates become naive midnights (all-day events)."""
+    if len(value) == 10:
+        return datetime.combine(date.fromisoformat(value), datetime.min.time()), True
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    # Expand in the event's own time zone so occurrences keep their wall-clock time across DST changes
+    return parsed.astimezone(tz), False
+
+def _parse_window(value, default):
+    """Parse a listing bound into an aware UTC datetime."""
+    if not value:
+        return default
+    parsed, all_day = _parse_time(value, timezone.utc)
+    return parsed.replace(tzinfo=timezone.utc) if all_day else parsed
+
+def _instance_suffix(occurrence, all_day):
+    """Return the suffix Google uses in the id of a recurring event instance."""
+    if all_day:
+        return occurrence.strftime('%Y%m%d')
+    return occurrence.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+def _format(occurrence, all_day):
+    return occurrence.date().isoformat() if all_day else occurrence.isoformat()
+
+def _occurrences(master, window_start, window_end):
+    """Return the starts of the master's occurrences that begin in [window_start, window_end),
+    memoized per event version and day-aligned window"""
+    tz = ZoneInfo(master['time_zone']) if master.get('time_zone') else timezone.utc
+    # Days of the event's time zone, UTC days would cut off the evening of zones west of UTC
+    window_day_start = window_start.astimezone(tz).date()
+    window_day_end = window_end.astimezone(tz).date() + timedelta(days=1)
+    key = (master['id'], master.get('updated'), window_day_start, window_day_end)
+    cached = _expansion_cache.get(key)
+    if cached is not None:
+        _expansion_cache.move_to_end(key)
+        return cached
+    dtstart, all_day = _parse_time(master['start'], tz)
+    start_bound = datetime.combine(window_day_start, datetime.min.time(), tz)
+    end_bound = datetime.combine(window_day_end, datetime.min.time(), tz)
+    if all_day:
+        start_bound = start_bound.replace(tzinfo=None)
+        end_bound = end_bound.replace(tzinfo=None)
+    # EXDATE and RDATE lines are part of the set, so excluded dates never come out
+    ruleset = rrulestr('\n'.join(master['recurrence']), dtstart=dtstart, forceset=True)
+    occurrences = tuple(ruleset.between(start_bound, end_bound, inc=True))
+    _expansion_cache[key] = occurrences
+    if len(_expansion_cache) > EXPANSION_CACHE_SIZE:
+        _expansion_cache.popitem(last=False)
+    return occurrences
+
+def expand_events(events, time_min=None, time_max=None):
+    """Replace recurring masters from list_events with their instances overlapping [time_min, time_max).
+    Modified instances returned by the API replace the generated ones and cancelled ones are dropped"""
+    now = datetime.now(timezone.utc)
+    window_start = _parse_window(time_min, now)
+    window_end = _parse_window(time_max, window_start + timedelta(days=DEFAULT_EXPANSION_DAYS))
+    # Instance id suffixes of the instances the API returned separately (moved or cancelled), by master id
+    exceptions = {}
+    for event in events:
+        if event.get('recurring_event_id') and event.get('original_start'):
+            original_start, all_day = _parse_time(event['original_start'], timezone.utc)
+            exceptions.setdefault(event['recurring_event_id'], set()).add(_instance_suffix(original_start, all_day))
+    expanded = []
+    for event in events:
+        if event.get('status') == 'cancelled':
+            continue
+        if not event.get('recurrence'):
+            expanded.append(event)
+            continue
+        try:
+            tz = ZoneInfo(event['time_zone']) if event.get('time_zone') else timezone.utc
+            start, all_day = _parse_time(event['start'], tz)
+            end, _ = _parse_time(event['end'], tz)
+            duration = end - start
+            # Occurrences that started before the window but are still running overlap it too
+            occurrences = _occurrences(event, window_start - duration, window_end)
+        except Exception as e:
+            logger.warning(f"Could not expand recurring event {event['id']}: {e}")
+            expanded.append(event)
+            continue
+        overridden = exceptions.get(event['id'], set())
+        for occurrence in occurrences:
+            occurrence_end = occurrence + duration
+            if all_day:
+                overlaps = occurrence < window_end.replace(tzinfo=None) and occurrence_end > window_start.replace(tzinfo=None)
+            else:
+                overlaps = occurrence < window_end and occurrence_end > window_start
+            if not overlaps:
+                continue
+            suffix = _instance_suffix(occurrence, all_day)
+            if suffix in overridden:
+                continue
+            instance = {key: value for key, value in event.items() if key != 'recurrence'}
+            instance['id'] = f"{event['id']}_{suffix}"
+            instance['start'] = _format(occurrence, all_day)
+            instance['end'] = _format(occurrence_end, all_day)
+            instance['recurring_event_id'] = event['id']
+            expanded.append(instance)
+    return expanded
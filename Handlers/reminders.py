@@ -0,0 +1,134 @@
+from DB import (save_reminders, get_pending_reminders, get_reminders_by_ids, get_event_reminder_minutes,
+                set_reminders_status, cancel_event_reminders, REMINDER_SENT, REMINDER_CANCELLED, MAX_ROW_ID)
+from Handlers.Calendar_API import to_timestamp
+from Handlers.resilience import call_async
+import heapq
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# How often due reminders are delivered
+REMINDER_TICK_SECONDS = int(os.getenv("REMINDER_TICK_SECONDS", "5"))
+# Only reminders due within this window are kept in memory
+REMINDER_WINDOW_SECONDS = int(os.getenv("REMINDER_WINDOW_SECONDS", "3600"))
+# How often the next window is loaded from the database, must be shorter than the window
+REMINDER_LOAD_SECONDS = REMINDER_WINDOW_SECONDS // 4
+# Number of reminders read or updated per query
+REMINDER_BATCH_SIZE = 500
+# A reminder that could not be sent is retried after this delay, doubled on every failure up to the cap
+REMINDER_RETRY_SECONDS = 30
+REMINDER_RETRY_CAP_SECONDS = 600
+
+# Min-heap of (remind_at, reminder_id) for reminders due before _loaded_until
+_reminder_heap = []
+_queued_ids = set()
+# Reminders due before this timestamp are in the heap, later ones are still only in the database
+_loaded_until = 0
+# Keyset position of the last reminder loaded from the database
+_last_loaded_key = (0, 0)
+# reminder_id -> failed sends, for reminders waiting to be retried
+_send_failures = {}
+
+
+def _push(remind_at, reminder_id):
+    """Queue a reminder in memory unless it is already queued."""
+    if reminder_id in _queued_ids:
+        return
+    _queued_ids.add(reminder_id)
+    heapq.heappush(_reminder_heap, (remind_at, reminder_id))
+
+def schedule_event_reminders(user_id, chat_id, event_id, title, start_time, minutes):
+    """Persist reminders for an event and queue the ones that fall in the loaded window."""
+    start = to_timestamp(start_time)
+    reminders = [{
+        'user_id': user_id,
+        'chat_id': chat_id,
+        'event_id': event_id,
+        'title': title,
+        'start_time': start_time,
+        'minutes': m,
+        'remind_at': int(start - m * 60),
+    } for m in minutes if start - m * 60 > time.time()]
+    if not reminders:
+        return []
+    reminder_ids = save_reminders(reminders)
+    for reminder, reminder_id in zip(reminders, reminder_ids):
+        # Reminders past the watermark are picked up by the next load
+        if reminder['remind_at'] < _loaded_until:
+            _push(reminder['remind_at'], reminder_id)
+    return reminder_ids
+
+def reschedule_event_reminders(user_id, chat_id, event_id, title, start_time, minutes=None):
+    """Replace the pending reminders of an event, keeping the existing offsets when none are given."""
+    if not minutes:
+        minutes = get_event_reminder_minutes(event_id)
+    # Cancelled reminders left in the heap are skipped at delivery time
+    cancel_event_reminders(event_id)
+    return schedule_event_reminders(user_id, chat_id, event_id, title, start_time, minutes)
+
+async def load_upcoming_reminders(context=None):
+    """JobQueue callback that moves reminders due in the next window from the database into memory."""
+    global _loaded_until, _last_loaded_key
+    until = int(time.time()) + REMINDER_WINDOW_SECONDS
+    loaded = 0
+    while True:
+        reminders = get_pending_reminders(*_last_loaded_key, until, limit=REMINDER_BATCH_SIZE)
+        for reminder in reminders:
+            _push(reminder['remind_at'], reminder['reminder_id'])
+        loaded += len(reminders)
+        if len(reminders) < REMINDER_BATCH_SIZE:
+            break
+        _last_loaded_key = (reminders[-1]['remind_at'], reminders[-1]['reminder_id'])
+    # Everything due before `until` is in memory now, the next load starts from there
+    _last_loaded_key = (until - 1, MAX_ROW_ID)
+    _loaded_until = until
+    if loaded:
+        logger.info(f"Loaded {loaded} upcoming reminder(s)")
+
+def _format_reminder(reminder):
+    """Build the notification text for a reminder."""
+    minutes = reminder['minutes']
+    if minutes >= 60 and minutes % 60 == 0:
+        when = f"{minutes // 60} hour(s)"
+    else:
+        when = f"{minutes} minute(s)"
+    return f"⏰ Reminder: {reminder['title']} starts in {when} ({reminder['start_time']})"
+
+async def send_due_reminders(context):
+    """JobQueue callback that sends every reminder whose time has come."""
+    now = time.time()
+    due_ids = []
+    while _reminder_heap and _reminder_heap[0][0] <= now:
+        _, reminder_id = heapq.heappop(_reminder_heap)
+        _queued_ids.discard(reminder_id)
+        due_ids.append(reminder_id)
+    for i in range(0, len(due_ids), REMINDER_BATCH_SIZE):
+        # Reminders cancelled since they were queued are no longer pending and drop out here
+        reminders = get_reminders_by_ids(due_ids[i:i + REMINDER_BATCH_SIZE])
+        if _send_failures:
+            pending_ids = {reminder['reminder_id'] for reminder in reminders}
+            for reminder_id in due_ids[i:i + REMINDER_BATCH_SIZE]:
+                if reminder_id not in pending_ids:
+                    _send_failures.pop(reminder_id, None)
+        sent_ids = []
+        expired_ids = []
+        for reminder in reminders:
+            # Reminders left over from a long downtime or retried for too long are useless once the event has started
+            if to_timestamp(reminder['start_time']) < now:
+                expired_ids.append(reminder['reminder_id'])
+                _send_failures.pop(reminder['reminder_id'], None)
+                continue
+            try:
+                await call_async('telegram', context.bot.send_message, chat_id=reminder['chat_id'], text=_format_reminder(reminder))
+                sent_ids.append(reminder['reminder_id'])
+                _send_failures.pop(reminder['reminder_id'], None)
+            except Exception as e:
+                # Already behind the load watermark, so only the heap can bring it back
+                failures = _send_failures[reminder['reminder_id']] = _send_failures.get(reminder['reminder_id'], 0) + 1
+                delay = min(REMINDER_RETRY_CAP_SECONDS, REMINDER_RETRY_SECONDS * 2 ** (failures - 1))
+                logger.error(f"Error sending reminder {reminder['reminder_id']}, retrying in {delay}s: {e}")
+                _push(now + delay, reminder['reminder_id'])
+        set_reminders_status(sent_ids, REMINDER_SENT)
+        set_reminders_status(expired_ids, REMINDER_CANCELLED)
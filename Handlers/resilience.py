@@ -0,0 +1,329 @@
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timedelta, timezone
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Requests per second allowed per provider, sized to each provider's quota
+PROVIDER_RATES = {
+    'openrouter': float(os.getenv("OPENROUTER_RATE_LIMIT", "5")),
+    'calendar': float(os.getenv("CALENDAR_RATE_LIMIT", "150")),
+    'telegram': float(os.getenv("TELEGRAM_RATE_LIMIT", "25")),
+}
+# Requests per second allowed per key (the user) for providers with a per-user quota, on top of the provider's rate
+KEY_RATES = {
+    'calendar': float(os.getenv("CALENDAR_USER_RATE_LIMIT", "10")),
+}
+# Per-key buckets kept per provider, the least recently used are dropped first
+KEY_BUCKETS_SIZE = 10000
+# Attempts per call, including the first one
+MAX_ATTEMPTS = 4
+# Exponential backoff starts here and never waits longer than the cap
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_CAP_SECONDS = 20
+# Consecutive failures that open a circuit, and how long it stays open before a trial call
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_SECONDS = 30
+# After a 429 the rate is multiplied by this, then grows back by RATE_RECOVERY per success
+RATE_BACKOFF_FACTOR = 0.5
+RATE_RECOVERY = 0.05
+# HTTP statuses that are worth retrying
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+# Errors without a status that are worth retrying, matched by class name so no client library is imported here
+RETRYABLE_ERRORS = {'APIConnectionError', 'NetworkError', 'RetryAfter', 'TimedOut', 'TimeoutError', 'ConnectionError', 'HttpLib2Error'}
+NON_RETRYABLE_ERRORS = {'BadRequest', 'Forbidden', 'InvalidToken'}
+# Reasons Google gives with a 403 when a quota, not a permission, was exceeded
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+METRICS_INTERVAL_SECONDS = 300
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider whose circuit is open."""
+
+
+class TokenBucket:
+    """Token bucket whose rate backs off on 429s and recovers on successes."""
+
+    def __init__(self, rate, capacity=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, cost=1):
+        """Take `cost` tokens and return how many seconds to wait before using them."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= cost
+            # A negative balance is paid back by waiting
+            return max(0.0, -self.tokens / self.rate)
+
+    def slow_down(self):
+        with self.lock:
+            self.rate = max(self.max_rate * 0.05, self.rate * RATE_BACKOFF_FACTOR)
+
+    def speed_up(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_RECOVERY)
+
+
+class CircuitBreaker:
+    """Fails fast after repeated failures, then lets a single trial call through after a cool-down."""
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        """Return True if a call may go through."""
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                if self.opened_at is None:
+                    logger.warning(f"Circuit opened after {self.failures} consecutive failures")
+                self.opened_at = time.monotonic()
+
+
+class Provider:
+    """Rate limiter, circuit breaker and counters of one external dependency."""
+
+    def __init__(self, name, rate, key_rate=None):
+        self.name = name
+        self.bucket = TokenBucket(rate)
+        self.key_rate = key_rate
+        # key -> TokenBucket, least recently used first
+        self.key_buckets = OrderedDict()
+        self.key_lock = threading.Lock()
+        self.breaker = CircuitBreaker()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+
+    def key_bucket(self, key):
+        """Return the bucket of a key, or None when the provider has no per-key quota or no key was given."""
+        if key is None or self.key_rate is None:
+            return None
+        with self.key_lock:
+            bucket = self.key_buckets.get(key)
+            if bucket is None:
+                bucket = self.key_buckets[key] = TokenBucket(self.key_rate)
+                if len(self.key_buckets) > KEY_BUCKETS_SIZE:
+                    self.key_buckets.popitem(last=False)
+            else:
+                self.key_buckets.move_to_end(key)
+            return bucket
+
+    def reserve(self, key_bucket, cost):
+        """Take tokens from the provider's bucket and the key's, returns how long to wait."""
+        wait = self.bucket.reserve(cost)
+        if key_bucket is not None:
+            wait = max(wait, key_bucket.reserve(cost))
+        return wait
+
+
+_providers = {name: Provider(name, rate, KEY_RATES.get(name)) for name, rate in PROVIDER_RATES.items()}
+
+
+def get_provider(name):
+    """Return the named provider, creating one with a default rate if needed."""
+    if name not in _providers:
+        _providers[name] = Provider(name, 5)
+    return _providers[name]
+
+def _error_status(error):
+    """Return the HTTP status of an error from the OpenAI, Google or Telegram clients, if any."""
+    status = getattr(error, 'status_code', None)
+    resp = getattr(error, 'resp', None)
+    if status is None and resp is not None:
+        status = getattr(resp, 'status', None)
+    return status
+
+def _rate_limit_reason(error):
+    """Return the reason of a Google 403 that reports an exceeded quota, or None."""
+    if _error_status(error) != 403:
+        return None
+    content = getattr(error, 'content', None) or b''
+    text = content.decode('utf-8', 'replace') if isinstance(content, bytes) else str(content)
+    text += str(getattr(error, 'error_details', ''))
+    # userRateLimitExceeded contains rateLimitExceeded, so the more specific one is checked first
+    for reason in sorted(RATE_LIMIT_REASONS, key=len, reverse=True):
+        if reason in text:
+            return reason
+    return None
+
+def _retry_after(error):
+    """Return the delay requested by the server in seconds, or None."""
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is None:
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None) or getattr(error, 'resp', None)
+        if headers is not None:
+            retry_after = headers.get('retry-after') or headers.get('Retry-After')
+    if retry_after is None:
+        return None
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def _is_retryable(error):
+    """Return True for rate limits, server errors, timeouts and connection failures."""
+    names = {cls.__name__ for cls in type(error).__mro__}
+    if names & NON_RETRYABLE_ERRORS:
+        return False
+    status = _error_status(error)
+    if status is not None:
+        return int(status) in RETRYABLE_STATUSES or _rate_limit_reason(error) is not None
+    return bool(names & RETRYABLE_ERRORS)
+
+def _backoff(attempt, error):
+    """Return how long to wait before the next attempt, honoring Retry-After."""
+    retry_after = _retry_after(error)
+    if retry_after is not None:
+        return min(retry_after, BACKOFF_CAP_SECONDS * 3)
+    # Full jitter keeps retries from many users from arriving together
+    return random.uniform(0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+def _before_call(provider):
+    """Check the circuit, raising CircuitOpenError if the provider is down."""
+    if not provider.breaker.allow():
+        provider.rejected += 1
+        raise CircuitOpenError(f"{provider.name} is unavailable, try again later")
+    provider.calls += 1
+
+def _after_failure(provider, key_bucket, error, attempt):
+    """Record a failed attempt and return the delay before retrying, or None to give up."""
+    if not _is_retryable(error):
+        # The provider answered, the request itself was wrong
+        provider.breaker.record_success()
+        return None
+    provider.failures += 1
+    reason = _rate_limit_reason(error)
+    # A user over their own quota says nothing about the provider's health or everyone else's rate
+    if reason == 'userRateLimitExceeded' and key_bucket is not None:
+        key_bucket.slow_down()
+    else:
+        provider.breaker.record_failure()
+        if _error_status(error) == 429 or reason or _retry_after(error) is not None:
+            provider.bucket.slow_down()
+    if attempt + 1 >= MAX_ATTEMPTS:
+        return None
+    provider.retries += 1
+    return _backoff(attempt, error)
+
+def _after_success(provider, key_bucket):
+    provider.breaker.record_success()
+    provider.bucket.speed_up()
+    if key_bucket is not None:
+        key_bucket.speed_up()
+
+def call(provider_name, fn, *args, cost=1, key=None, deadline=None, **kwargs):
+    """Call fn(*args, **kwargs) under the provider's rate limit, retry policy and circuit breaker.
+    `key` (the user ID) also applies the provider's per-user rate. `deadline` (a time.monotonic() value) stops
+    retrying once the next attempt would start after it. Thread-only: rate limit waits and backoff
+    sleep for up to a minute, so it refuses to run on the event loop, use call_async or asyncio.to_thread there"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        raise RuntimeError(f"resilience.call('{provider_name}') would block the event loop, run it in a worker thread")
+    provider = get_provider(provider_name)
+    key_bucket = provider.key_bucket(key)
+    for attempt in range(MAX_ATTEMPTS):
+        _before_call(provider)
+        time.sleep(provider.reserve(key_bucket, cost))
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            delay = _after_failure(provider, key_bucket, e, attempt)
+            if delay is None or (deadline is not None and time.monotonic() + delay >= deadline):
+                raise
+            logger.warning(f"{provider_name} call failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        _after_success(provider, key_bucket)
+        return result
+
+async def call_async(provider_name, fn, *args, cost=1, key=None, **kwargs):
+    """Await fn(*args, **kwargs) under the provider's rate limit, retry policy and circuit breaker."""
+    provider = get_provider(provider_name)
+    key_bucket = provider.key_bucket(key)
+    for attempt in range(MAX_ATTEMPTS):
+        _before_call(provider)
+        await asyncio.sleep(provider.reserve(key_bucket, cost))
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception as e:
+            delay = _after_failure(provider, key_bucket, e, attempt)
+            if delay is None:
+                raise
+            logger.warning(f"{provider_name} call failed ({e}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+        _after_success(provider, key_bucket)
+        return result
+
+def get_resilience_metrics():
+    """Return the current state of every provider's limiter and breaker."""
+    return {name: {
+        'circuit': provider.breaker.state,
+        'consecutive_failures': provider.breaker.failures,
+        'rate': round(provider.bucket.rate, 2),
+        'keys': len(provider.key_buckets),
+        'calls': provider.calls,
+        'retries': provider.retries,
+        'failures': provider.failures,
+        'rejected': provider.rejected,
+    } for name, provider in _providers.items()}
+
+async def log_resilience_metrics(context=None):
+    """JobQueue callback that logs the state of every provider."""
+    for name, metrics in get_resilience_metrics().items():
+        logger.info(f"Provider {name}: {metrics}")
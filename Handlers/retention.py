@@ -0,0 +1,81 @@
+from DB import (get_history_user_counts, get_history_over_limit, get_history_older_than, delete_history_messages, incremental_vacuum,
+                invalidate_user_history)
+from datetime import datetime, timedelta, timezone
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Number of most recent messages kept per user
+CHAT_HISTORY_MAX_MESSAGES = int(os.getenv("CHAT_HISTORY_MAX_MESSAGES", "200"))
+# Per-user overrides of the message limit, e.g. "12345:1000,67890:50"
+CHAT_HISTORY_USER_LIMITS = {
+    user_id.strip(): int(limit)
+    for user_id, limit in (entry.split(':', 1) for entry in os.getenv("CHAT_HISTORY_USER_LIMITS", "").split(',') if ':' in entry)
+}
+# Messages older than this are archived regardless of the per-user limit
+CHAT_HISTORY_MAX_AGE_DAYS = int(os.getenv("CHAT_HISTORY_MAX_AGE_DAYS", "30"))
+# Directory of the gzip-compressed JSONL archives
+CHAT_HISTORY_ARCHIVE_DIR = os.getenv("CHAT_HISTORY_ARCHIVE_DIR", "archive")
+# Messages moved per transaction, kept small so other writers never wait long
+RETENTION_BATCH_SIZE = 500
+# Pause between batches to let handlers take the write lock
+RETENTION_BATCH_PAUSE_SECONDS = 0.05
+# Free pages returned to the filesystem per run
+RETENTION_VACUUM_PAGES = 1000
+RETENTION_INTERVAL_SECONDS = int(os.getenv("RETENTION_INTERVAL_SECONDS", "3600"))
+
+_vacuum_warning_logged = False
+
+
+def _archive_path():
+    """Return today's archive file, one gzip member is appended per batch."""
+    os.makedirs(CHAT_HISTORY_ARCHIVE_DIR, exist_ok=True)
+    return os.path.join(CHAT_HISTORY_ARCHIVE_DIR, f"chat_history-{datetime.now(timezone.utc):%Y%m%d}.jsonl.gz")
+
+def _archive_batch(rows):
+    """Append the rows to the archive, then delete them from the hot table."""
+    with gzip.open(_archive_path(), 'at', encoding='utf-8') as archive:
+        for row in rows:
+            archive.write(json.dumps(row, ensure_ascii=False) + '\n')
+    # Rows are only deleted once they are safely archived
+    delete_history_messages([row['msg_id'] for row in rows])
+    # The next read of these users reloads what is left of their history
+    invalidate_user_history({row['user_id'] for row in rows})
+    time.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+    return len(rows)
+
+def _user_limit(user_id):
+    """Return the number of messages kept for a user."""
+    return CHAT_HISTORY_USER_LIMITS.get(str(user_id), CHAT_HISTORY_MAX_MESSAGES)
+
+def run_retention():
+    """Archive messages that are too old or over their user's limit, then reclaim free pages.
+    Returns the number of archived messages"""
+    global _vacuum_warning_logged
+    archived = 0
+    # Age limit first, it usually removes most rows
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=CHAT_HISTORY_MAX_AGE_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    while rows := get_history_older_than(cutoff, RETENTION_BATCH_SIZE):
+        archived += _archive_batch(rows)
+    # Then per-user limits, starting from the smallest configured limit
+    min_limit = min([CHAT_HISTORY_MAX_MESSAGES, *CHAT_HISTORY_USER_LIMITS.values()])
+    for user_id in get_history_user_counts(min_limit):
+        keep = _user_limit(user_id)
+        while rows := get_history_over_limit(user_id, keep, RETENTION_BATCH_SIZE):
+            archived += _archive_batch(rows)
+    if archived and not incremental_vacuum(RETENTION_VACUUM_PAGES) and not _vacuum_warning_logged:
+        logger.warning("Database does not use incremental auto_vacuum; run 'PRAGMA auto_vacuum = INCREMENTAL; VACUUM;' once to let it shrink")
+        _vacuum_warning_logged = True
+    return archived
+
+async def retention_job(context=None):
+    """JobQueue callback that runs the retention pass in a worker thread."""
+    started = time.perf_counter()
+    archived = await asyncio.to_thread(run_retention)
+    if archived:
+        logger.info(f"Archived {archived} chat message(s) in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,152 @@
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Fraction of records kept per level, e.g. "DEBUG:0.05,INFO:0.5", warnings and errors are always kept
+LOG_SAMPLE_RATES = {
+    level.strip().upper(): float(rate)
+    for level, rate in (entry.split(':', 1) for entry in os.getenv("LOG_SAMPLE_RATES", "DEBUG:0.05").split(',') if ':' in entry)
+}
+# Records below WARNING allowed per second, the excess is dropped so a burst of traffic can't flood the output
+LOG_MAX_RECORDS_PER_SECOND = int(os.getenv("LOG_MAX_RECORDS_PER_SECOND", "200"))
+# Records waiting for the writer thread, logging never blocks once the queue is full
+LOG_QUEUE_SIZE = 10000
+# Longest message or extra field written, and longest traceback
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "500"))
+LOG_MAX_TRACEBACK_CHARS = 4000
+
+# Correlation ids of the update being handled, copied into every record logged while handling it
+request_id_var = ContextVar('request_id', default=None)
+user_id_var = ContextVar('user_id', default=None)
+
+# Attributes every LogRecord has, anything else was passed with extra= and is written as a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'request_id', 'user_id'}
+
+_listener = None
+
+
+def _cap(value, limit=LOG_MAX_FIELD_CHARS):
+    """Truncate a string, noting how much was cut."""
+    if len(value) <= limit:
+        return value
+    return f"{value[:limit]}... (+{len(value) - limit} chars)"
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line with size-capped fields."""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': _cap(record.getMessage()),
+        }
+        for key in ('request_id', 'user_id'):
+            if getattr(record, key, None) is not None:
+                entry[key] = record.__dict__[key]
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value if isinstance(value, (int, float, bool)) or value is None else _cap(str(value))
+        if record.exc_text:
+            entry['exc'] = _cap(record.exc_text, LOG_MAX_TRACEBACK_CHARS)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of the records of each level and caps the rate of records below WARNING."""
+
+    def __init__(self, sample_rates=None, max_per_second=LOG_MAX_RECORDS_PER_SECOND):
+        super().__init__()
+        self.sample_rates = LOG_SAMPLE_RATES if sample_rates is None else sample_rates
+        self.max_per_second = max_per_second
+        self.window = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.sample_rates.get(record.levelname, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            return False
+        with self.lock:
+            window = int(time.monotonic())
+            if window != self.window:
+                self.window = window
+                self.count = 0
+            self.count += 1
+            return self.count <= self.max_per_second
+
+
+class BoundedQueueHandler(QueueHandler):
+    """Hands records to the writer thread without blocking, dropping them when the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Runs in the logging thread, so the context variables of the update being handled are still visible
+        record.request_id = request_id_var.get()
+        record.user_id = user_id_var.get()
+        # Merge the arguments and render the traceback now, the record may hold objects that change later
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            warning = logging.LogRecord(__name__, logging.WARNING, __file__, 0, f"Dropped {dropped} log record(s), the log queue was full", None, None)
+            try:
+                self.queue.put_nowait(warning)
+            except queue.Full:
+                self.dropped += dropped
+
+
+def setup_logging(level=LOG_LEVEL):
+    """Route every logger through a bounded queue to a writer thread printing JSON lines on stdout.
+    Callers never wait for console I/O, records are sampled and rate limited before they are queued"""
+    global _listener
+    if _listener is not None:
+        return
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = BoundedQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    # Client libraries log every HTTP request at INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    # Flush what is still queued when the bot exits
+    atexit.register(_listener.stop)
+
+def bind_log_context(update_id=None, user_id=None):
+    """Set the correlation ids attached to records logged while handling an update."""
+    request_id_var.set(update_id)
+    user_id_var.set(user_id)
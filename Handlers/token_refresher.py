@@ -0,0 +1,152 @@
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request
+from datetime import timezone
+import asyncio
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Refresh tokens this many seconds before they expire
+REFRESH_LEAD_SECONDS = int(os.getenv("TOKEN_REFRESH_LEAD_SECONDS", "300"))
+# Spread refreshes over this many extra seconds so users don't all refresh at once
+REFRESH_JITTER_SECONDS = int(os.getenv("TOKEN_REFRESH_JITTER_SECONDS", "120"))
+# Maximum number of refreshes running at the same time
+REFRESH_CONCURRENCY = int(os.getenv("TOKEN_REFRESH_CONCURRENCY", "8"))
+# How often the background job checks for tokens that are due
+REFRESH_INTERVAL_SECONDS = int(os.getenv("TOKEN_REFRESH_INTERVAL_SECONDS", "30"))
+# Delay before retrying a refresh that failed
+REFRESH_RETRY_SECONDS = 60
+# Users who haven't used the bot for this long stop being refreshed, their next message refreshes on demand
+REFRESH_IDLE_SECONDS = int(os.getenv("TOKEN_REFRESH_IDLE_SECONDS", str(24 * 3600)))
+
+# Min-heap of (due_timestamp, user_id), stale entries are skipped lazily
+_refresh_heap = []
+# user_id -> due timestamp of the live heap entry for that user
+_scheduled = {}
+# user_id -> Credentials object shared with authenticate_user
+_credentials = {}
+# user_id -> last time authenticate_user handed out the credentials
+_last_used = {}
+_lock = threading.Lock()
+
+
+def token_path(user_id):
+    """Return the path of the token file for a user."""
+    return f'tokens/{user_id}.json'
+
+def save_credentials(user_id, creds):
+    """Write the user's credentials back to their token file."""
+    os.makedirs('tokens', exist_ok=True)
+    with open(token_path(user_id), 'w') as token_file:
+        token_file.write(creds.to_json())
+
+def _expiry_timestamp(creds):
+    """Return the expiry of the credentials as a unix timestamp, or None."""
+    if creds.expiry is None:
+        return None
+    # google-auth stores the expiry as a naive UTC datetime
+    return creds.expiry.replace(tzinfo=timezone.utc).timestamp()
+
+def _schedule(user_id, due):
+    """Push a refresh for the user onto the heap, replacing any older entry. Caller holds the lock."""
+    _scheduled[user_id] = due
+    heapq.heappush(_refresh_heap, (due, user_id))
+
+def _schedule_refresh(user_id, creds):
+    """Schedule the next refresh of the credentials before they expire. Caller holds the lock."""
+    # Already scheduled for these credentials, nothing to do
+    if _credentials.get(user_id) is creds and user_id in _scheduled:
+        return
+    _credentials[user_id] = creds
+    expiry = _expiry_timestamp(creds)
+    if expiry is not None:
+        _schedule(user_id, expiry - REFRESH_LEAD_SECONDS - random.uniform(0, REFRESH_JITTER_SECONDS))
+
+def track_credentials(user_id, creds):
+    """Start tracking the credentials of a user who is using the bot, so they are refreshed before they expire.
+    Tracking stops once the user has been idle for REFRESH_IDLE_SECONDS"""
+    if not creds or not creds.refresh_token:
+        return
+    with _lock:
+        _last_used[user_id] = time.time()
+        _schedule_refresh(user_id, creds)
+
+def get_tracked_credentials(user_id):
+    """Return the cached credentials for the user if they are still valid, otherwise None."""
+    with _lock:
+        creds = _credentials.get(user_id)
+    if creds is not None and creds.valid:
+        return creds
+    return None
+
+def untrack_credentials(user_id):
+    """Stop refreshing the user's credentials."""
+    with _lock:
+        _untrack(user_id)
+
+def _untrack(user_id):
+    """Forget a user's credentials and pending refresh. Caller holds the lock."""
+    _credentials.pop(user_id, None)
+    _scheduled.pop(user_id, None)
+    _last_used.pop(user_id, None)
+
+def _pop_due(now):
+    """Pop every user whose refresh is due at the given time, untracking the ones who have gone idle."""
+    due_users = []
+    idle = 0
+    with _lock:
+        while _refresh_heap and _refresh_heap[0][0] <= now:
+            due, user_id = heapq.heappop(_refresh_heap)
+            # Skip entries that were replaced by a newer schedule
+            if _scheduled.get(user_id) != due:
+                continue
+            del _scheduled[user_id]
+            if _last_used.get(user_id, 0) < now - REFRESH_IDLE_SECONDS:
+                _untrack(user_id)
+                idle += 1
+                continue
+            creds = _credentials.get(user_id)
+            if creds is not None:
+                due_users.append((user_id, creds))
+    if idle:
+        logger.info(f"Stopped refreshing the tokens of {idle} idle user(s)")
+    return due_users
+
+def _refresh(user_id, creds):
+    """Refresh the credentials and persist them. Runs in a worker thread."""
+    creds.refresh(Request())
+    save_credentials(user_id, creds)
+
+async def _refresh_one(user_id, creds, semaphore):
+    """Refresh a single user's token, rescheduling it on success or failure."""
+    async with semaphore:
+        try:
+            await asyncio.to_thread(_refresh, user_id, creds)
+        except Exception as e:
+            # invalid_grant and the like, the token was revoked or expired for good and retrying can't help
+            if isinstance(e, RefreshError) and not getattr(e, 'retryable', False):
+                logger.warning(f"Token of user {user_id} can no longer be refreshed, untracking it: {e}")
+                untrack_credentials(user_id)
+                return
+            logger.warning(f"Token refresh failed for user {user_id}: {e}")
+            with _lock:
+                if user_id in _credentials:
+                    _schedule(user_id, time.time() + REFRESH_RETRY_SECONDS + random.uniform(0, REFRESH_JITTER_SECONDS))
+            return
+    with _lock:
+        if user_id in _credentials:
+            _schedule_refresh(user_id, creds)
+
+async def refresh_due_tokens(context=None):
+    """JobQueue callback that refreshes every token that is about to expire."""
+    due_users = _pop_due(time.time())
+    if not due_users:
+        return
+    logger.info(f"Refreshing {len(due_users)} Google token(s) in the background")
+    semaphore = asyncio.Semaphore(REFRESH_CONCURRENCY)
+    await asyncio.gather(*(_refresh_one(user_id, creds, semaphore) for user_id, creds in due_users))
@@ -0,0 +1,48 @@
+"""Time conflict checks against a user's busy index.
+
+    python -m benchmarks.bench_busy_index --intervals 20000 --queries 10000
+
+Each query is what a create costs before the event is inserted: the overlap lookup, plus the
+nearest free slot search when there is a conflict."""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark busy index conflict checks")
+    parser.add_argument('--intervals', type=int, default=20000, help="events in the index")
+    parser.add_argument('--queries', type=int, default=10000)
+    parser.add_argument('--days', type=int, default=365, help="span the events are spread over")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    # DB is imported by the index module and needs a database to open
+    os.environ.setdefault('DATABASE_URL', os.path.join(tempfile.mkdtemp(prefix='bench-busy-'), 'bench.db'))
+    from Handlers.busy_index import BusyIndex
+
+    rng = random.Random(args.seed)
+    now = time.time()
+    span = args.days * 86400
+    intervals = []
+    for i in range(args.intervals):
+        start = now + rng.uniform(0, span)
+        intervals.append((start, start + rng.choice((900, 1800, 3600, 7200)), f"event {i}"))
+    index = BusyIndex(intervals)
+    queries = [now + rng.uniform(0, span) for _ in range(args.queries)]
+
+    conflicts = 0
+    started = time.perf_counter()
+    for start in queries:
+        if index.overlapping(start, start + 3600):
+            conflicts += 1
+            index.nearest_free_slot(start, start + 3600)
+    elapsed = time.perf_counter() - started
+    print(f"{args.queries} checks over {args.intervals} intervals, {conflicts} with conflicts: "
+          f"{elapsed / args.queries * 1e6:.1f} us per check", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Time a digest run over many users against an in-process fake Calendar service and bot.
+
+    python -m benchmarks.bench_digest --users 2000 --latency 0.05
+
+The resilience layer's default rates apply unless --calendar-rate/--telegram-rate are given, so the
+result shows the floor the quotas put on a real run (about users / calendar rate seconds once the
+time zone cache is warm)."""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the morning digest fan-out")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds each fake API call takes")
+    parser.add_argument('--calendar-rate', help="overrides CALENDAR_RATE_LIMIT")
+    parser.add_argument('--telegram-rate', help="overrides TELEGRAM_RATE_LIMIT")
+    parser.add_argument('--concurrency', help="overrides DIGEST_CONCURRENCY")
+    return parser.parse_args()
+
+
+class FakeRequest:
+    def __init__(self, result, latency):
+        self.result = result
+        self.latency = latency
+
+    def execute(self):
+        time.sleep(self.latency)
+        return self.result
+
+
+class FakeCalendar:
+    """Answers the two calls a digest makes, the time zone setting and the day's events."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def settings(self):
+        return self
+
+    def events(self):
+        return self
+
+    def get(self, setting):
+        return FakeRequest({'value': 'UTC'}, self.latency)
+
+    def list(self, **kwargs):
+        event = {'id': 'standup', 'summary': 'Standup', 'start': {'dateTime': '2025-01-01T09:00:00Z'}, 'end': {'dateTime': '2025-01-01T09:15:00Z'}}
+        return FakeRequest({'items': [event]}, self.latency)
+
+
+class FakeBot:
+    def __init__(self, latency):
+        self.latency = latency
+
+    async def send_message(self, chat_id, text):
+        await asyncio.sleep(self.latency)
+
+
+async def run(args, digest):
+    user_ids = list(range(1, args.users + 1))
+    # 08:00 UTC is inside every UTC user's digest window
+    now = datetime(2025, 1, 1, 8, tzinfo=timezone.utc)
+    report = await digest.send_digests(FakeBot(args.latency), user_ids, now)
+    print(f"{report['users']} users: {report['sent']} sent, {len(report['failed'])} failed in {report['seconds']:.1f}s "
+          f"({report['sent'] / report['seconds']:.1f} digests/s)")
+
+
+def main():
+    args = parse_args()
+    directory = tempfile.mkdtemp(prefix='bench-digest-')
+    # Configuration is read at import time, so it is set before the bot's modules are imported
+    os.environ['DATABASE_URL'] = os.path.join(directory, 'bench.db')
+    os.environ['DIGEST_TIMEZONE_FILE'] = os.path.join(directory, 'timezones.json')
+    for name, value in (('CALENDAR_RATE_LIMIT', args.calendar_rate), ('TELEGRAM_RATE_LIMIT', args.telegram_rate),
+                        ('DIGEST_CONCURRENCY', args.concurrency)):
+        if value is not None:
+            os.environ[name] = value
+    from Handlers import digest
+    digest._load_credentials = lambda user_id: None
+    digest._build_service = lambda creds: FakeCalendar(args.latency)
+    print(f"Calendar {os.getenv('CALENDAR_RATE_LIMIT', 'default')}/s, Telegram {os.getenv('TELEGRAM_RATE_LIMIT', 'default')}/s, "
+          f"{digest.DIGEST_CONCURRENCY} digest threads, {args.latency * 1000:.0f} ms per call", file=sys.stderr)
+    asyncio.run(run(args, digest))
+
+
+if __name__ == "__main__":
+    main()
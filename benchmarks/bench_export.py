@@ -0,0 +1,53 @@
+"""Measure the peak memory of a history export at growing table sizes.
+
+    python -m benchmarks.bench_export --rows 10000 100000 300000
+
+Rows are inserted straight into a fresh database, then exported with tracemalloc running.
+A flat peak across sizes shows the export streams instead of loading the table."""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+def fill_history(path, rows, users=100):
+    """Insert rows of chat history spread over a number of users."""
+    conn = sqlite3.connect(path)
+    conn.executemany('INSERT INTO chat_history (user_id, role, message) VALUES (?, ?, ?)',
+                     ((str(i % users), 'user' if i % 2 else 'assistant', f"message {i} " + 'x' * 200) for i in range(rows)))
+    conn.commit()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark streaming exports")
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--format', choices=('jsonl', 'csv'), default='csv')
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp(prefix='bench-export-')
+    # A single shard keeps the row count of every run in one file
+    os.environ['DATABASE_URL'] = os.path.join(directory, 'bench.db')
+    os.environ['DATABASE_SHARDS'] = '1'
+    import DB
+    from Handlers.export import export_table
+
+    inserted = 0
+    for rows in sorted(args.rows):
+        fill_history(DB.DATABASE_URL, rows - inserted)
+        inserted = rows
+        output = os.path.join(directory, f"history.{args.format}")
+        tracemalloc.start()
+        started = time.perf_counter()
+        count = export_table('history', output, args.format)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{count} rows in {elapsed:.1f}s, peak traced memory {peak / 1024 / 1024:.2f} MiB, "
+              f"file {os.path.getsize(output) / 1024 / 1024:.0f} MiB", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
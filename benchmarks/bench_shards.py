@@ -0,0 +1,59 @@
+"""Measure chat history write throughput for different shard counts.
+
+    python -m benchmarks.bench_shards --shards 1 2 4 --threads 16 --writes 4000
+
+Each shard count runs in a fresh process, since DATABASE_SHARDS is read at import time.
+Writer threads call save_user_message for many users, like concurrent chats would."""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+def run_worker(writes, threads, users):
+    """Write `writes` messages from `threads` threads and print the rate, in the current process."""
+    import DB
+    per_thread = writes // threads
+    errors = []
+
+    def write(offset):
+        try:
+            for i in range(per_thread):
+                DB.save_user_message((offset * per_thread + i) % users, 'user', f"message {i}")
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=write, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    print(f"{DB.DATABASE_SHARDS} shard(s): {per_thread * threads / elapsed:.0f} writes/s"
+          + (f", {len(errors)} thread(s) failed: {errors[0]}" if errors else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sharded history writes")
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--writes', type=int, default=4000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        run_worker(args.writes, args.threads, args.users)
+        return
+    for shards in args.shards:
+        directory = tempfile.mkdtemp(prefix=f'bench-shards-{shards}-')
+        env = dict(os.environ, DATABASE_URL=os.path.join(directory, 'bench.db'), DATABASE_SHARDS=str(shards))
+        subprocess.run([sys.executable, '-m', 'benchmarks.bench_shards', '--worker', '--threads', str(args.threads),
+                        '--writes', str(args.writes), '--users', str(args.users)], env=env, check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,40 @@
 from openai import OpenAI
 from dotenv import load_dotenv
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import Application, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes
 import os
 import logging
-from DB import save_user_message, get_user_history, get_all_user_history, clear_user_history
-from Handlers.Calendar_API import authenticate_user, create_event_dict, create_event, list_events, delete_event, update_event
+from DB import save_user_message, get_user_history, get_all_user_history, clear_user_history, cancel_event_reminders, get_history_cache_stats, acquire_database_lock
+from Handlers.Calendar_API import authenticate_user, create_event_dict, create_event, list_events, delete_event, update_event, parse_reminder_minutes, create_reminders_dict
+from Handlers.model_router import complete, log_model_stats
+from Handlers.resilience import log_resilience_metrics, METRICS_INTERVAL_SECONDS
+from Handlers.token_refresher import refresh_due_tokens, REFRESH_INTERVAL_SECONDS
+from Handlers.ics_import import import_ics_file
+from Handlers.export import export_user_data, EXPORT_FORMATS
+from Handlers.retention import retention_job, RETENTION_INTERVAL_SECONDS
+from Handlers.calendar_prefetch import prefetch_calendar, list_events_prefetched, CalendarContext
+from Handlers.digest import digest_job, DIGEST_ENABLED, DIGEST_INTERVAL_SECONDS
+from Handlers.idempotency import claim_update, release_update, prune_processed_updates_job, PRUNE_INTERVAL_SECONDS, CLAIMED, DUPLICATE
+from Handlers.event_sync import reconcile_events_job, EVENT_SYNC_INTERVAL_SECONDS
+from Handlers.busy_index import find_conflicts, record_busy_interval, forget_busy_interval
+from Handlers.event_search import match_events, ambiguous_matches, forget_event
+from Handlers.structured_logging import setup_logging, bind_log_context
+from Handlers.profiler import (ADMIN_USER_IDS, PROFILE_HANDLER_GROUP, is_admin, is_profiling, parse_profile_args,
+                               start_profiling, stop_profiling, count_profiled_update)
+from Handlers.reminders import schedule_event_reminders, reschedule_event_reminders, load_upcoming_reminders, send_due_reminders, REMINDER_TICK_SECONDS, REMINDER_LOAD_SECONDS
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.oauth2.credentials import Credentials
 from functools import partial
 import re
+import asyncio
+import tempfile
+import time
 import googleapiclient.discovery_cache
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 googleapiclient.discovery_cache.DISABLE_FILE_CACHE = True
 
-# Enable logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Enable logging, records are written as JSON lines by a background thread
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Global OpenAI client
@@ -27,8 +43,11 @@ client = None
 # Global google calendar service
 service = None
 
-async def chat_with_gpt(prompt, user_id, client, user_history=None, system_message=None):
-    """Function to interact with OpenAI API"""
+# Telegram rejects messages longer than this
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+async def chat_with_gpt(prompt, user_id, client, user_history=None, system_message=None, task="chat"):
+    """Function to interact with OpenAI API, `task` selects the model route ("chat" or "intent")"""
     if system_message:
         messages = [{"role": "system", "content": system_message}]  
     else:
@@ -40,30 +59,46 @@ async def chat_with_gpt(prompt, user_id, client, user_history=None, system_messa
     # Add the user prompt to the messages    
     messages.append({"role": "user", "content": prompt})
     try:
-        response = client.chat.completions.create(
-            model="meta-llama/llama-3-8b-instruct",
-            messages=messages,
-        )
+        # Routed to the fastest healthy model for the task, off the event loop
+        response = await complete(client, messages, task)
         # Save the user message to the database
         save_user_message(user_id, "user", prompt)
-        print(f"User {user_id} message saved: {prompt}")
         # Save the AI response to the database
-        save_user_message(user_id, "assistant", response.choices[0].message.content)
-        print(f"User {user_id} response saved: {response.choices[0].message.content}")
+        save_user_message(user_id, "assistant", response)
+        logger.debug(f"Saved a {len(prompt)} char message and a {len(response)} char response")
         # Return the AI response
-        return response.choices[0].message.content
+        return response
     except Exception as e:
         logger.error(f"Error calling OpenAI API: {e}")
+        # The message wasn't handled, let the user resend it right away instead of it being taken for a double send
+        await asyncio.to_thread(release_update, user_id, prompt)
         return "Sorry, I'm having trouble processing your request right now."
 
+def claim_content(message):
+    """Return what a double send of the message is recognised by: its text, or the file of a document"""
+    if message.document:
+        return f"document:{message.document.file_unique_id}"
+    return message.text
+
+async def claim_message(update: Update):
+    """Claim the update before handling it, returns False if it was already handled.
+    A redelivered update was answered already, a double send gets a short note so the user isn't left waiting"""
+    outcome = await asyncio.to_thread(claim_update, update.update_id, update.effective_user.id, claim_content(update.message))
+    if outcome == DUPLICATE:
+        await update.message.reply_text("👍 Already on it, you sent this a moment ago.")
+    return outcome == CLAIMED
+
 async def handle_AI(update: Update, context: ContextTypes.DEFAULT_TYPE, client=None):
     """Handle regular text messages"""
     user_message = update.message.text
     user_name = update.effective_user.first_name
     user_id = update.effective_user.id
+    # Redelivered updates and double sends were already answered
+    if not await claim_message(update):
+        return
     
-    # Log the incoming message
-    logger.info(f"Message from {user_name}: {user_message}")
+    # Log the incoming message, its text stays out of the logs
+    logger.info(f"AI message from {user_name} ({len(user_message)} chars)")
     
     # Send typing action to show bot is processing
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
@@ -77,10 +112,261 @@ async def handle_AI(update: Update, context: ContextTypes.DEFAULT_TYPE, client=N
         
     except Exception as e:
         logger.error(f"Error handling message: {e}")
+        await asyncio.to_thread(release_update, user_id, user_message)
         await update.message.reply_text(
             "Sorry, I encountered an error while processing your message. Please try again."
         )
 
+class IntentContext:
+    """State shared by the intents of one message"""
+
+    def __init__(self, user_id, chat_id, calendar_context):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.calendar_context = calendar_context
+        # Set once an intent changed the calendar, later lookups then bypass the prefetched events
+        self.calendar_changed = False
+        # Set when a Calendar change failed, the message may then be sent again right away
+        self.failed = False
+
+    def list_events(self, service, time_min=None, time_max=None):
+        """List events in a range, from the prefetched window while it is still accurate"""
+        if self.calendar_changed:
+            return list_events(service, max_results=9999, time_min=time_min, time_max=time_max, user_id=self.user_id)
+        return list_events_prefetched(self.calendar_context, time_min, time_max, service=service, user_id=self.user_id)
+
+
+def parse_intents(response):
+    """Split the model output into one dict of fields per Action block"""
+    intents = []
+    for line in response.splitlines():
+        if ':' not in line:
+            continue
+        key, value = line.split(':', 1)
+        key = key.strip()
+        value = value.strip().strip('"')
+        if key == 'Action':
+            intents.append({'Action': value.lower()})
+        elif intents:
+            intents[-1][key] = value
+    return [intent for intent in intents if intent['Action'] in INTENT_RUNNERS]
+
+def optional_field(intent, key):
+    """Return a field of an intent, or None when the model left it empty or N/A"""
+    value = intent.get(key, '')
+    return None if value in ["", "N/A"] else value
+
+def format_event_dict(title, event_dict):
+    """Build the reply describing an event dictionary"""
+    reply_text = f"{title}:\n"
+    for key, value in event_dict.items():
+        reply_text += f"{key}: {value}\n"
+    return reply_text.rstrip()
+
+def format_time(timestamp):
+    """Format a unix timestamp as an ISO 8601 UTC time"""
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+async def run_create_intent(intent, intent_context, service):
+    """Create the event described by an intent and return the reply text"""
+    user_id = intent_context.user_id
+    reminder_minutes = parse_reminder_minutes(intent.get('Reminders'))
+    event_dict = {
+        'summary': intent.get('Summary', ''),
+        'location': intent.get('Location', ''),
+        'description': intent.get('Description', ''),
+        'start': {'dateTime': intent.get('Start Time', '')},
+        'end': {'dateTime': intent.get('End Time', '')},
+    }
+    if reminder_minutes:
+        event_dict['reminders'] = create_reminders_dict(reminder_minutes)
+    logger.debug(f"Creating event: {event_dict}")
+    reply_text = ""
+    # Warn about overlapping events before inserting, using the local busy index
+    conflicts, free_slot = find_conflicts(user_id, event_dict['start']['dateTime'], event_dict['end']['dateTime'])
+    if conflicts:
+        reply_text += "⚠️ This event overlaps with:\n"
+        for start, end, title in conflicts[:5]:
+            reply_text += f"• {title} ({format_time(start)} - {format_time(end)})\n"
+        if free_slot:
+            reply_text += f"Nearest free slot: {format_time(free_slot[0])} - {format_time(free_slot[1])}\n"
+    # Call the function to create the event in Google Calendar
+    created_event = await asyncio.to_thread(create_event, service=service, event=event_dict, user_id=user_id)
+    if not created_event:
+        intent_context.failed = True
+        return reply_text + f"❌ Could not create {event_dict['summary']}."
+    intent_context.calendar_changed = True
+    record_busy_interval(user_id, event_dict['summary'], event_dict['start']['dateTime'], event_dict['end']['dateTime'])
+    if reminder_minutes:
+        # Also remind the user from the bot itself
+        schedule_event_reminders(user_id, intent_context.chat_id, created_event.get('id'), event_dict['summary'], event_dict['start']['dateTime'], reminder_minutes)
+    return reply_text + format_event_dict("Event created with details", event_dict)
+
+async def run_list_intent(intent, intent_context, service):
+    """List the events described by an intent and return the reply text"""
+    time_min = optional_field(intent, 'Start Time')
+    time_max = optional_field(intent, 'End Time')
+    logger.debug(f"Listing events with time_min: {time_min}, time_max: {time_max}")
+    events = await asyncio.to_thread(intent_context.list_events, service, time_min, time_max)
+    if not events:
+        return "No events found."
+    replies = []
+    for i, event in enumerate(events):
+        replies.append(f"""Event {i+1}:
+Summary: {event['summary']}{"\nLocation: " + event['location'] if event['location'] else ''}{"\nDescription: " + event['description'] if event['description'] else ''}
+Start Time: {event['start']}{"\nEnd Time: " + event['end'] if event['end'] else ''}""")
+    return "\n\n".join(replies)
+
+async def find_intent_event(intent, intent_context, service, action):
+    """Find the event an update or delete intent refers to.
+    Returns (event, None) when found, or (None, reply text) when it is missing or ambiguous"""
+    events = await asyncio.to_thread(intent_context.list_events, service, optional_field(intent, 'Start Time'), optional_field(intent, 'End Time'))
+    # Rank the events by title similarity instead of requiring an exact match
+    matches = match_events(intent_context.user_id, intent.get('Summary', ''), events)
+    if not matches:
+        return None, f"No event found to {action} with the provided summary."
+    candidates = ambiguous_matches(matches, intent.get('Summary', ''))
+    if candidates:
+        return None, format_candidates(action, candidates)
+    return matches[0][1], None
+
+async def run_update_intent(intent, intent_context, service):
+    """Update the event described by an intent and return the reply text"""
+    user_id = intent_context.user_id
+    reminder_minutes = parse_reminder_minutes(intent.get('Reminders'))
+    event_dict = {}
+    # Summary is the model's description of the event to find, the title only changes on an explicit rename
+    if optional_field(intent, 'New Summary'):
+        event_dict['summary'] = intent['New Summary']
+    if optional_field(intent, 'Location'):
+        event_dict['location'] = intent['Location']
+    if optional_field(intent, 'Description'):
+        event_dict['description'] = intent['Description']
+    if optional_field(intent, 'Start Time'):
+        event_dict['start'] = {'dateTime': intent['Start Time']}
+    if optional_field(intent, 'End Time'):
+        event_dict['end'] = {'dateTime': intent['End Time']}
+    if reminder_minutes:
+        event_dict['reminders'] = create_reminders_dict(reminder_minutes)
+    logger.debug(f"The event dictionary to update: {event_dict}")
+    matched_event, reply_text = await find_intent_event(intent, intent_context, service, "update")
+    if matched_event is None:
+        return reply_text
+    logger.debug(f"Found event to update: {matched_event['id']}")
+    event_dict['id'] = matched_event['id']
+    # Call the function to update the event in Google Calendar
+    updated_event = await asyncio.to_thread(update_event, service=service, event_id=event_dict.get('id'), updated_event=event_dict, user_id=user_id)
+    if not updated_event:
+        intent_context.failed = True
+        return f"❌ Could not update {matched_event['summary']}."
+    intent_context.calendar_changed = True
+    forget_busy_interval(user_id, matched_event['summary'], matched_event['start'], matched_event['end'])
+    record_busy_interval(user_id, updated_event.get('summary', ''), updated_event['start'].get('dateTime', updated_event['start'].get('date')), updated_event['end'].get('dateTime', updated_event['end'].get('date')))
+    if reminder_minutes or event_dict.get('start'):
+        # Move the bot reminders along with the event
+        reschedule_event_reminders(user_id, intent_context.chat_id, updated_event['id'], updated_event.get('summary', ''), updated_event['start'].get('dateTime', updated_event['start'].get('date')), reminder_minutes)
+    return format_event_dict("Event updated with details", {'summary': updated_event.get('summary', matched_event['summary']), **event_dict})
+
+async def run_delete_intent(intent, intent_context, service):
+    """Delete the event described by an intent and return the reply text"""
+    event_dict = {
+        'summary': intent.get('Summary', ''),
+        'start': {'dateTime': intent.get('Start Time', '')},
+        'end': {'dateTime': intent.get('End Time', '')},
+    }
+    event, reply_text = await find_intent_event(intent, intent_context, service, "delete")
+    if event is None:
+        return reply_text
+    logger.debug(f"Found event to delete: {event['id']}")
+    if not await asyncio.to_thread(delete_event, service=service, event_id=event['id'], user_id=intent_context.user_id):
+        intent_context.failed = True
+        return f"❌ Could not delete {event['summary']}."
+    intent_context.calendar_changed = True
+    cancel_event_reminders(event['id'])
+    forget_event(intent_context.user_id, event['id'])
+    forget_busy_interval(intent_context.user_id, event['summary'], event['start'], event['end'])
+    return format_event_dict("Event deleted with details", event_dict)
+
+INTENT_RUNNERS = {
+    'create': run_create_intent,
+    'list': run_list_intent,
+    'update': run_update_intent,
+    'delete': run_delete_intent,
+}
+# Maximum number of intent groups of one message running at the same time
+MAX_PARALLEL_INTENTS = 4
+# Words too common to tell two event titles apart
+TITLE_STOPWORDS = {'a', 'an', 'the', 'my', 'with', 'at', 'on', 'in', 'for', 'to', 'of', 'and'}
+
+def group_intents(intents):
+    """Group intents that may touch the same event, keeping their order inside each group.
+    Creates, updates and deletes whose titles share a word end up in the same group, list intents
+    form a last group of their own so they see the changes made by the rest of the message"""
+    groups = []
+    group_words = []
+    lists = []
+    for position, intent in enumerate(intents):
+        if intent['Action'] == 'list':
+            lists.append((position, intent))
+            continue
+        words = set(re.findall(r'\w+', intent.get('Summary', '').lower())) - TITLE_STOPWORDS
+        for group, shared_words in zip(groups, group_words):
+            if words & shared_words:
+                group.append((position, intent))
+                shared_words.update(words)
+                break
+        else:
+            groups.append([(position, intent)])
+            group_words.append(words)
+    return groups, lists
+
+async def execute_intents(intents, intent_context):
+    """Run the intents of a message, independent ones concurrently, and return their replies in order"""
+    replies = [None] * len(intents)
+    semaphore = asyncio.Semaphore(MAX_PARALLEL_INTENTS)
+
+    async def run_group(group, service):
+        async with semaphore:
+            # Calendar service objects are not thread-safe, so every concurrent group gets its own
+            if service is None:
+                service = await asyncio.to_thread(authenticate_user, intent_context.user_id)
+            for position, intent in group:
+                try:
+                    replies[position] = await INTENT_RUNNERS[intent['Action']](intent, intent_context, service)
+                except Exception as e:
+                    logger.error(f"Error running {intent['Action']} intent: {e}")
+                    intent_context.failed = True
+                    replies[position] = f"❌ Could not {intent['Action']} {intent.get('Summary', 'the event')}."
+
+    groups, lists = group_intents(intents)
+    # The first group reuses the service warmed up by the prefetch
+    await asyncio.gather(*(run_group(group, intent_context.calendar_context.service if i == 0 else None) for i, group in enumerate(groups)))
+    if lists:
+        await asyncio.gather(*(run_group([item], intent_context.calendar_context.service if i == 0 else None) for i, item in enumerate(lists)))
+    return replies
+
+async def reply_in_chunks(update: Update, text):
+    """Reply with a long text, split on blank lines to stay under Telegram's message size limit"""
+    chunk = ""
+    for part in text.split("\n\n"):
+        if chunk and len(chunk) + len(part) + 2 > TELEGRAM_MESSAGE_LIMIT:
+            await update.message.reply_text(chunk)
+            chunk = ""
+        chunk = f"{chunk}\n\n{part}" if chunk else part
+        while len(chunk) > TELEGRAM_MESSAGE_LIMIT:
+            await update.message.reply_text(chunk[:TELEGRAM_MESSAGE_LIMIT])
+            chunk = chunk[TELEGRAM_MESSAGE_LIMIT:]
+    if chunk:
+        await update.message.reply_text(chunk)
+
+def format_candidates(action, candidates):
+    """Build the message asking the user which of several similar events they meant"""
+    reply_text = f"I found several events that could be the one to {action}:\n"
+    for i, (_, event) in enumerate(candidates):
+        reply_text += f"{i+1}. {event['summary']} ({event['start']})\n"
+    reply_text += "Please tell me which one by repeating the request with its exact title or time."
+    return reply_text
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, client=None, service=None):
     """Handle incoming messages"""
     if client is None:
@@ -90,8 +376,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, cli
     # Extract information from the user message
     user_id = update.effective_user.id
     user_message = update.message.text
+    # Redelivered updates and double sends were already answered, don't call the model or create the events twice
+    if not await claim_message(update):
+        return
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-    print(datetime.now().isoformat())
     now = datetime.now().isoformat()
     system_message = f"""# Google Calendar API Agent System Prompt
 
@@ -111,6 +399,12 @@ End Time: [ISO 8601 format: YYYY-MM-DDTHH:MM:SS or YYYY-MM-DDTHH:MM:SS-HH:MM wit
 Reminders: [minutes before event, e.g., "15" for 15 minutes, or "N/A" if not specified]
 ```
 
+For UPDATE actions, Summary identifies the event to change. Add one more line, only for UPDATE actions:
+
+```
+New Summary: [new event title if the user explicitly asks to rename the event, otherwise "N/A"]
+```
+
 ### For LIST Actions
 
 ```
@@ -131,6 +425,10 @@ Start Time: [ISO 8601 format or "N/A" if not specified]
 End Time: [ISO 8601 format or "N/A" if not specified]
 ```
 
+### For Messages with Several Requests
+
+If the message asks for more than one thing, output one block per request in the order they were asked, separated by a blank line. Every block starts with its own `Action:` line and follows the format of its action type.
+
 ## Critical Rules
 
 1. **Error Handling**: 
@@ -165,6 +463,7 @@ End Time: [ISO 8601 format or "N/A" if not specified]
    - If start time not specified: use "N/A", do not assume a default time
    - If end time not specified: use "N/A", do not assume a default time
 8. **Default Values for UPDATE**:
+   - If the user does not explicitly ask to rename the event: use "N/A" for New Summary
    - If location not specified: use "N/A"
    - If description not specified: use "N/A"
    - If reminders not specified: use "N/A"
@@ -213,6 +512,20 @@ Description: N/A
 Start Time: 2025-08-13T15:00:00Z
 End Time: 2025-08-13T16:00:00Z
 Reminders: 30
+New Summary: N/A
+```
+
+Input: "Rename my dentist appointment to Dental checkup"
+Output:
+```
+Action: update
+Summary: Dentist appointment
+Location: N/A
+Description: N/A
+Start Time: N/A
+End Time: N/A
+Reminders: N/A
+New Summary: Dental checkup
 ```
 
 **DELETE Examples**:
@@ -234,6 +547,24 @@ Start Time: N/A
 End Time: N/A
 ```
 
+**MULTIPLE REQUESTS Example**:
+Input: "Book lunch with Sarah tomorrow at noon and delete my dentist appointment"
+Output:
+```
+Action: create
+Summary: Lunch with Sarah
+Location: N/A
+Description: N/A
+Start Time: 2025-08-14T12:00:00Z
+End Time: 2025-08-14T13:00:00Z
+Reminders: N/A
+
+Action: delete
+Summary: Dentist appointment
+Start Time: N/A
+End Time: N/A
+```
+
 **ERROR Examples**:
 Input: "I want to do something"
 Output:
@@ -255,147 +586,27 @@ Error
 - Be conservative with assumptions - use "N/A" when information is unclear
 - For list actions, only include fields that can be determined from the input
 - Ensure all times are in valid ISO 8601 format that Google Calendar API accepts"""
-    response = await chat_with_gpt(user_message, update.effective_user.id, client=client, user_history= get_user_history(user_id), system_message=system_message)
+    # Warm the Calendar service and fetch the events around today while the model parses the message
+    prefetch = asyncio.create_task(asyncio.to_thread(prefetch_calendar, user_id))
+    response = await chat_with_gpt(user_message, update.effective_user.id, client=client, user_history= get_user_history(user_id), system_message=system_message, task="intent")
     response = response.strip().split("```")[1] if "```" in response else response.strip()
-    await update.message.reply_text(response)
-    print(re.search(r'Action: create', response))
-    service = authenticate_user(user_id)
-    # Check if the response indicates a create action
-    if re.search(r'Action: create', response) is not None and service:
-        print("----"*50)
-        print("Creating event...")
-        print("----"*50)
-        # Convert the event string to a dictionary
-        event_dict = {}
-        for line in response.splitlines():
-            if ':' in line:
-                key, value = line.split(':', 1)
-                event_dict[key.strip()] = value.strip().strip('"')
-        # Here you would typically call a function to create the event in the calendar
-        event_dict = {
-            'summary': event_dict.get('Summary', ''),
-            'location': event_dict.get('Location', ''),
-            'description': event_dict.get('Description', ''),
-            'start': {'dateTime': event_dict.get('Start Time', '')},
-            'end': {'dateTime': event_dict.get('End Time', '')},
-        }
-        print(event_dict)
-        # Call the function to create the event in Google Calendar
-        create_event(service=service, event=event_dict, user_id=user_id)
-        reply_text = f"Event created with details:\n"
-        for key, value in event_dict.items():
-            reply_text += f"{key}: {value}\n"
-        await update.message.reply_text(reply_text)
-    elif re.search(r'Action: list', response) is not None and service:
-        print("----"*50)
-        print("Listing events...")
-        print("----"*50)
-        # Here you would typically call a function to list the events
-        for line in response.splitlines():
-            if ':' in line:
-                key, value = line.split(':', 1)
-                if key.strip() == 'Start Time':
-                    time_min = value.strip().strip('"')
-                elif key.strip() == 'End Time':
-                    time_max = value.strip().strip('"')
-                elif key.strip() == 'Location':
-                    location = value.strip().strip('"')    
-                else:
-                    location = None
-                    time_min = None
-                    time_max = None
-        print(f"Listing events with location: {location}, time_min: {time_min}, time_max: {time_max}")   
-        events = list_events(service, max_results=9999, time_min=time_min, time_max=time_max)  
-        for i,event in enumerate(events):
-            print(event)
-            print("----"*50)
-            await update.message.reply_text(f"""Event {i+1}:
-Summary: {event['summary']}{"\nLocation: " + event['location'] if event['location'] else ''}{"\nDescription: " + event['description'] if event['description'] else ''}
-Start Time: {event['start']}{"\nEnd Time: " + event['end'] if event['end'] else ''}""")
-    elif re.search(r'Action: update', response) is not None and service:
-        print("----"*50)
-        print("Updating event...")
-        print("----"*50)
-        # Convert the event string to a dictionary
-        event_dict = {}
-        for line in response.splitlines():
-            if ':' in line:
-                key, value = line.split(':', 1)
-                event_dict[key.strip()] = value.strip().strip('"')
-        # Here you would typically call a function to update the event in the calendar
-        event_dict = {
-            'summary': event_dict.get('Summary', ''),
-            'location': event_dict.get('Location', ''),
-            'description': event_dict.get('Description', ''),
-            'start': {'dateTime': event_dict.get('Start Time', '')},
-            'end': {'dateTime': event_dict.get('End Time', '')},
-        }
-        if event_dict.get('start').get('dateTime') in ["N/A",""]:
-            event_dict.pop('start')
-            print("Start time is N/A, removing from event dictionary.")
-        if event_dict.get('end').get('dateTime') in ["N/A",""]:
-            event_dict.pop('end')
-            print("End time is N/A, removing from event dictionary.")
-        if event_dict.get('location') in ["N/A",""]:
-            event_dict.pop('location')
-            print("Location is N/A, setting to empty string.")  
-        if event_dict.get('description') in ["N/A",""]:
-            event_dict.pop('description')
-            print("Description is N/A, setting to empty string.")            
-        print("The event dictionary to update:")
-        print(event_dict)
-        events = list_events(service, max_results=9999, time_max=event_dict.get('end').get('dateTime') if event_dict.get('end') else None, time_min=event_dict.get('start').get('dateTime') if event_dict.get('start') else None)
-        Found_event = False
-        for event in events:
-            if event['summary'] == event_dict.get('summary', ''):
-                print(f"Found event to update: {event}")
-                event_dict['id'] = event['id']
-                Found_event = True
-                break
-        if not Found_event:
-            await update.message.reply_text("No event found to update with the provided summary.")
-            return 
-        # Call the function to update the event in Google Calendar
-        update_event(service=service, event_id=event_dict.get('id'), updated_event=event_dict)
-        reply_text = f"Event updated with details:\n"
-        for key, value in event_dict.items():
-            reply_text += f"{key}: {value}\n"
-        await update.message.reply_text(reply_text)
-    elif re.search(r'Action: delete', response) is not None and service:
-        print("----"*50)
-        print("Deleting event...")
-        print("----"*50)
-        # Convert the event string to a dictionary
-        event_dict = {}
-        for line in response.splitlines():
-            if ':' in line:
-                key, value = line.split(':', 1)
-                event_dict[key.strip()] = value.strip().strip('"')
-        # Here you would typically call a function to delete the event in the calendar
-        event_dict = {
-            'summary': event_dict.get('Summary', ''),
-            'start': {'dateTime': event_dict.get('Start Time', '')},
-            'end': {'dateTime': event_dict.get('End Time', '')},
-        }
-        print(event_dict)
-        print(event_dict.get('end').get('dateTime') if event_dict.get('end').get('dateTime') not in ["", "N/A"] else None)
-        print(event_dict.get('start').get('dateTime') if event_dict.get('start').get('dateTime') not in ["", "N/A"] else None)
-        events = list_events(service, max_results=9999, time_max=event_dict.get('end').get('dateTime') if event_dict.get('end').get('dateTime') not in ["", "N/A"] else None, time_min=event_dict.get('start').get('dateTime') if event_dict.get('start').get('dateTime') not in ["", "N/A"] else None)
-        print(events)
-        Found_event = False
-        for event in events:
-            if event['summary'] == event_dict.get('summary', ''):
-                print(f"Found event to delete: {event}")
-                delete_event(service=service, event_id=event['id'])
-                Found_event = True
-                break
-        if not Found_event:
-            await update.message.reply_text("No event found to delete with the provided summary.")
-            return 
-        reply_text = f"Event deleted with details:\n"
-        for key, value in event_dict.items():
-            reply_text += f"{key}: {value}\n"
-        await update.message.reply_text(reply_text)    
+    try:
+        calendar_context = await prefetch
+    except Exception as e:
+        logger.error(f"Calendar prefetch failed for user {user_id}: {e}")
+        calendar_context = CalendarContext(await asyncio.to_thread(authenticate_user, user_id))
+    intents = parse_intents(response)
+    if not intents or not calendar_context.service:
+        await update.message.reply_text(response)
+        return
+    logger.info(f"Executing {len(intents)} intent(s): {[intent['Action'] for intent in intents]}")
+    intent_context = IntentContext(user_id, update.effective_chat.id, calendar_context)
+    replies = await execute_intents(intents, intent_context)
+    if intent_context.failed:
+        # Resending the message retries what failed instead of being taken for a double send
+        await asyncio.to_thread(release_update, user_id, user_message)
+    # One aggregated reply for the whole message
+    await reply_in_chunks(update, "\n\n".join(replies))
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle the /start command"""
@@ -429,7 +640,7 @@ async def connect_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle the /connect command to authenticate user with Google Calendar"""
     user_id = update.effective_user.id
     try:
-        service = authenticate_user(user_id)
+        service = await asyncio.to_thread(authenticate_user, user_id)
         if service:
             await update.message.reply_text("✅ You have been successfully authenticated with Google Calendar! You can now create, update, and delete events.")
         else:
@@ -452,6 +663,8 @@ Welcome! I'm your intelligent calendar assistant. Here's what I can do for you:
 
 🤖 `/AI` - Ask me any questions or get assistance with anything
 
+📦 `/export` - Download your message history and created events (add `csv` for CSV files)
+
 ❓ `/help` - Show this help message
 
 *✨ Smart Calendar Management:*
@@ -462,6 +675,7 @@ Simply send me a natural message containing what you want to do with your calend
 • **List** events: "Show me my events for next week"  
 • **Update** events: "Move my dentist appointment to Friday"
 • **Delete** events: "Cancel the team meeting on Monday"
+• **Import** events: send me an `.ics` file exported from another calendar
 
 *💡 How it works:*
 1. Connect your Google account using `/connect`
@@ -488,9 +702,113 @@ async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     clear_user_history(user_id)
     await update.message.reply_text("🗑️ Your message history has been cleared.")
 
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /export command to send the user their message history and created events"""
+    user_id = update.effective_user.id
+    fmt = context.args[0].lower() if context.args else 'jsonl'
+    if fmt not in EXPORT_FORMATS:
+        await update.message.reply_text(f"Usage: /export [{'|'.join(EXPORT_FORMATS)}]")
+        return
+    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="upload_document")
+    with tempfile.TemporaryDirectory() as directory:
+        # Rows are streamed to disk in a worker thread so large exports don't block other users
+        paths = await asyncio.to_thread(export_user_data, user_id, directory, fmt)
+        for path in paths:
+            with open(path, 'rb') as export_file:
+                await update.message.reply_document(export_file, filename=os.path.basename(path))
+
+async def handle_ics_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Import the events of an uploaded .ics file into the user's calendar"""
+    user_id = update.effective_user.id
+    # A redelivered or resent file would import every event again
+    if not await claim_message(update):
+        return
+    service = await asyncio.to_thread(authenticate_user, user_id)
+    if not service:
+        await update.message.reply_text("❌ Please connect your Google Calendar with /connect first.")
+        return
+    progress_message = await update.message.reply_text("📥 Importing your calendar file...")
+    last_edit = 0.0
+
+    async def report_progress(created, failed):
+        nonlocal last_edit
+        # Telegram limits how often a message can be edited, so progress is throttled
+        if time.monotonic() - last_edit < 3:
+            return
+        last_edit = time.monotonic()
+        try:
+            await progress_message.edit_text(f"📥 Importing your calendar file...\n✅ {created} imported, ❌ {failed} failed")
+        except Exception as e:
+            logger.warning(f"Could not update import progress: {e}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'import.ics')
+        ics_file = await update.message.document.get_file()
+        await ics_file.download_to_drive(path)
+        created, failed = await import_ics_file(path, service, user_id, on_progress=report_progress)
+    await progress_message.edit_text(f"✅ Import finished: {created} event(s) imported" + (f", {failed} failed." if failed else "."))
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the admin-only /profile command: `/profile [updates|<seconds>s|stop]`"""
+    if not is_admin(update.effective_user.id):
+        return
+    if context.args and context.args[0].lower() == 'stop':
+        await finish_profiling(context)
+        return
+    try:
+        max_updates, max_seconds = parse_profile_args(context.args)
+    except ValueError:
+        await update.message.reply_text("Usage: /profile [updates|<seconds>s|stop]")
+        return
+    if not start_profiling(update.effective_chat.id, max_updates, max_seconds, update.update_id):
+        await update.message.reply_text("🔬 Profiling is already running, use /profile stop to end it.")
+        return
+    # Stops the run after max_seconds even if fewer updates arrived
+    context.job_queue.run_once(finish_profiling, max_seconds, name='profile_timeout')
+    limit = f"the next {max_updates} update(s) or {max_seconds}s" if max_updates else f"{max_seconds}s"
+    await update.message.reply_text(f"🔬 Profiling {limit}.")
+
+async def finish_profiling(context: ContextTypes.DEFAULT_TYPE):
+    """Stop the profiling run and send its summary and collapsed stacks to the admin who started it"""
+    for job in context.job_queue.get_jobs_by_name('profile_timeout'):
+        job.schedule_removal()
+    result = await asyncio.to_thread(stop_profiling)
+    if result is None:
+        return
+    chat_id, path, summary = result
+    await context.bot.send_message(chat_id=chat_id, text=summary[:TELEGRAM_MESSAGE_LIMIT])
+    with open(path, 'rb') as stacks_file:
+        await context.bot.send_document(chat_id=chat_id, document=stacks_file, filename=os.path.basename(path))
+
+async def count_profiled_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Count updates handled while profiling, runs after every other handler"""
+    if is_profiling() and count_profiled_update(update.update_id):
+        await finish_profiling(context)
+
+async def bind_update_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Tag every record logged while handling the update with its update and user ids"""
+    bind_log_context(update.update_id, update.effective_user.id if update.effective_user else None)
+
+async def log_history_cache_stats(context: ContextTypes.DEFAULT_TYPE):
+    """Log the hit rate and memory of the in-memory chat history"""
+    stats = get_history_cache_stats()
+    logger.info(f"History cache: {stats['hit_rate']:.1%} hits, {stats['users']} user(s), {stats['bytes'] / 1024 / 1024:.1f} MiB, {stats['evictions']} eviction(s)")
+
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle errors"""
-    logger.error(f"Update {update} caused error {context.error}")
+    if not isinstance(update, Update):
+        logger.error(f"Error outside an update: {type(context.error).__name__}", exc_info=context.error)
+        return
+    # Ids and the traceback only, the update itself carries the user's message
+    user_id = update.effective_user.id if update.effective_user else None
+    # Error handlers may run outside the update's context, so its correlation ids are bound again
+    bind_log_context(update.update_id, user_id)
+    logger.error(f"Update {update.update_id} of user {user_id} failed with {type(context.error).__name__}", exc_info=context.error)
+    # Let the user resend the message right away instead of it being taken for a double send
+    if update.message and claim_content(update.message):
+        await asyncio.to_thread(release_update, user_id, claim_content(update.message))
+    if not update.effective_chat:
+        return
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
         text="An error occurred while processing your request. Please try again later."
@@ -514,6 +832,13 @@ def main():
     if not telegram_bot_token:
         logger.error("TELEGRAM_BOT_TOKEN not found in environment variables")
         return
+
+    # Held until the bot exits, so the shards can't be rebalanced under it
+    try:
+        database_lock = acquire_database_lock()
+    except RuntimeError as e:
+        logger.error(f"Not starting: {e}")
+        return
     
     # Initialize OpenAI client
     global client
@@ -529,19 +854,54 @@ def main():
     # Create the Application
     application = Application.builder().token(telegram_bot_token).build()
     
+    # Runs before every other handler so all of an update's logs carry its correlation ids
+    application.add_handler(TypeHandler(Update, bind_update_context), group=-1)
+
     # Add command handlers
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("clear", clear_command))
     application.add_handler(CommandHandler("connect", connect_command))
+    application.add_handler(CommandHandler("export", export_command))
+    # Without admins the profiler hooks aren't registered at all
+    if ADMIN_USER_IDS:
+        application.add_handler(CommandHandler("profile", profile_command))
+        application.add_handler(TypeHandler(Update, count_profiled_updates), group=PROFILE_HANDLER_GROUP)
     
 
     # Add message handler for text messages
     application.add_handler(MessageHandler(filters.Regex(r'^/AI\s+.*'), ai_handler_with_client))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler_with_client_and_service))
+    # An import takes minutes, it runs alongside other updates instead of holding them back
+    application.add_handler(MessageHandler(filters.Document.FileExtension("ics"), handle_ics_document, block=False))
     
     # Add error handler
     application.add_error_handler(error_handler)
+
+    # Refresh Google tokens in the background so handlers rarely see an expired one
+    application.job_queue.run_repeating(refresh_due_tokens, interval=REFRESH_INTERVAL_SECONDS, first=REFRESH_INTERVAL_SECONDS)
+
+    # Load upcoming reminders from the database and deliver them when they are due
+    application.job_queue.run_repeating(load_upcoming_reminders, interval=REMINDER_LOAD_SECONDS, first=0)
+    application.job_queue.run_repeating(send_due_reminders, interval=REMINDER_TICK_SECONDS, first=REMINDER_TICK_SECONDS)
+
+    # Archive old chat history so the hot table stays small
+    application.job_queue.run_repeating(retention_job, interval=RETENTION_INTERVAL_SECONDS, first=60)
+
+    # Pick up edits and deletions made to the bot's events outside the bot
+    application.job_queue.run_repeating(reconcile_events_job, interval=EVENT_SYNC_INTERVAL_SECONDS, first=EVENT_SYNC_INTERVAL_SECONDS)
+
+    # Send each connected user their agenda as their morning comes
+    if DIGEST_ENABLED:
+        application.job_queue.run_repeating(digest_job, interval=DIGEST_INTERVAL_SECONDS, first=60)
+
+    # Forget update IDs too old to be redelivered
+    application.job_queue.run_repeating(prune_processed_updates_job, interval=PRUNE_INTERVAL_SECONDS, first=PRUNE_INTERVAL_SECONDS)
+
+    # Log rate limiter and circuit breaker state of every external API
+    application.job_queue.run_repeating(log_resilience_metrics, interval=METRICS_INTERVAL_SECONDS, first=METRICS_INTERVAL_SECONDS)
+    application.job_queue.run_repeating(log_history_cache_stats, interval=METRICS_INTERVAL_SECONDS, first=METRICS_INTERVAL_SECONDS)
+    application.job_queue.run_repeating(log_model_stats, interval=METRICS_INTERVAL_SECONDS, first=METRICS_INTERVAL_SECONDS)
     
     # Initialize the bot
     application.bot.initialize()
@@ -549,6 +909,7 @@ def main():
     # Start the bot
     logger.info("Starting bot...")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
+    database_lock.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,27 @@
+from Handlers.recurrence import expand_events
+
+
+def daily_master(start, end, time_zone):
+    return {
+        'id': 'standup',
+        'summary': 'Standup',
+        'start': start,
+        'end': end,
+        'time_zone': time_zone,
+        'recurrence': ['RRULE:FREQ=DAILY'],
+        'updated': '2025-01-01T00:00:00Z',
+    }
+
+
+def test_window_west_of_utc_keeps_evening_occurrence():
+    # 18:00 in Denver is already the next day in UTC, the 19:00 instance of that evening is still in the window
+    master = daily_master('2024-12-01T19:00:00-07:00', '2024-12-01T20:00:00-07:00', 'America/Denver')
+    instances = expand_events([master], '2025-01-01T18:00:00-07:00', '2025-01-01T23:00:00-07:00')
+    assert [instance['start'] for instance in instances] == ['2025-01-01T19:00:00-07:00']
+    assert instances[0]['id'] == 'standup_20250102T020000Z'
+
+
+def test_window_east_of_utc_keeps_morning_occurrence():
+    master = daily_master('2024-12-01T07:00:00+09:00', '2024-12-01T08:00:00+09:00', 'Asia/Tokyo')
+    instances = expand_events([master], '2025-01-02T06:00:00+09:00', '2025-01-02T09:00:00+09:00')
+    assert [instance['start'] for instance in instances] == ['2025-01-02T07:00:00+09:00']